@@ -0,0 +1,395 @@
+import h5py as h5
+import numpy as np
+
+from .connectedpixels import (blob_moments, s_1, avg_i, f_raw, s_raw, o_raw,
+                              m_ff, m_ss, m_sf, bb_mn_o)
+from .labelimage import labelimage, flip1
+from .nxreader import NXReader
+
+
+class NXPeakSearch(object):
+    """Search successive frames for peaks using the connectedpixels extension.
+
+    By default, 2D blobs are found in each frame and merged into 3D peaks
+    within pixel and frame tolerances by 'merge_peaks'. If 'search3d' is
+    True, the blob image of each frame is overlapped with that of the
+    previous frame using 'labelimage.mergelast', so that the peaks are
+    connected in three dimensions and their moments, including those in
+    omega, are computed in C during the search.
+
+    If 'first' and 'last' are given, only 3D peaks that start within that
+    frame range are retained, which allows a frame range to be split into
+    blocks that are searched independently (see 'search_block').
+    """
+
+    pixel_tolerance = 50
+    frame_tolerance = 10
+
+    def __init__(self, shape, threshold, mask=None, search3d=False,
+                 first=None, last=None):
+        self.shape = shape
+        self.threshold = threshold
+        self.mask = mask
+        self.search3d = search3d
+        self.first = first
+        self.last = last
+        self.lio = labelimage(shape, flipper=flip1)
+        self.tables = []
+        self.finalised = False
+
+    def search(self, frame, z):
+        """Search a single frame, whose frame number is z"""
+        omega = np.float32(z)
+        self.lio.peaksearch(frame, self.threshold, omega)
+        if self.search3d:
+            closed = self.lio.lastres
+            self.lio.mergelast()
+            self.add_peaks(closed)
+        elif self.lio.res is not None:
+            blob_moments(self.lio.res)
+            self.tables.append(peak_table(self.lio.res, omega))
+
+    def search_frames(self, reader, first, last, limit=None):
+        """Search frames first to last-1, yielding after each slab is read.
+
+        The frames are read in slabs by an NXReader. In 3D mode, the search
+        continues beyond 'last', but not beyond 'limit', one chunk at a
+        time, until there are no open peaks that started before 'self.last'.
+        """
+        for i, j, v in reader.slabs(first, last):
+            yield i
+            for k in range(j-i):
+                self.search(v[k], i+k)
+        if limit is None or not self.is_open():
+            return
+        for i, j, v in reader.slabs(last, limit, reader.chunk_frames,
+                                    prefetch=0):
+            yield i
+            for k in range(j-i):
+                if not self.is_open():
+                    return
+                self.search(v[k], i+k)
+            if not self.is_open():
+                return
+
+    def is_open(self):
+        """Return True if a 3D peak started before 'self.last' is incomplete"""
+        res = self.lio.lastres
+        if not self.search3d or self.last is None or res is None:
+            return False
+        return np.any((res[:,s_1] > 0) & (res[:,bb_mn_o] < self.last))
+
+    def add_peaks(self, res):
+        """Add 3D peaks that have no overlap with the current frame"""
+        if res is not None:
+            valid = res[:,s_1] > 0
+            if self.first is not None:
+                valid &= res[:,bb_mn_o] >= self.first
+            if self.last is not None:
+                valid &= res[:,bb_mn_o] < self.last
+            if np.any(valid):
+                self.tables.append(peak_table(res[valid]))
+
+    def add_table(self, table):
+        """Add a peak table returned by 'search_block'"""
+        if len(table) > 0:
+            self.tables.append(table)
+
+    def finalise(self):
+        if self.search3d and not self.finalised:
+            self.lio.finalise()
+            self.add_peaks(self.lio.lastres)
+        self.finalised = True
+
+    def get_table(self):
+        """Return the table of all the blobs or 3D peaks found so far"""
+        self.finalise()
+        if self.tables:
+            return np.concatenate(self.tables)
+        else:
+            return np.empty((0, 8), dtype=np.float64)
+
+    def get_peaks(self, z_min, z_max):
+        """Return a list of NXpeak instances found between z_min and z_max"""
+        table = self.get_table()
+        table = table[valid_peaks(table, self.mask)]
+        if len(table) == 0:
+            return []
+        elif self.search3d:
+            table = table[np.argsort(table[:,4], kind='mergesort')]
+            return [NXpeak(*row, threshold=self.threshold,
+                           pixel_tolerance=self.pixel_tolerance,
+                           frame_tolerance=self.frame_tolerance)
+                    for row in table]
+        else:
+            return merge_peaks(table, self.threshold, self.pixel_tolerance,
+                               self.frame_tolerance, z_min, z_max)
+
+
+class NXpeak(object):
+
+    def __init__(self, np, average, x, y, z, sigx, sigy, covxy, threshold,
+                 pixel_tolerance, frame_tolerance):
+        self.np = np
+        self.average = average
+        self.intensity = np * average
+        self.x = x
+        self.y = y
+        self.z = z
+        self.sigx = sigx
+        self.sigy = sigy
+        self.covxy = covxy
+        self.threshold = threshold
+        self.peaks = [self]
+        self.pixel_tolerance = pixel_tolerance**2
+        self.frame_tolerance = frame_tolerance
+        self.combined = False
+
+    def __str__(self):
+        return "Peak x=%f y=%f z=%f np=%i avg=%f" % (self.x, self.y, self.z, self.np, self.average)
+
+    def __repr__(self):
+        return "Peak x=%f y=%f z=%f np=%i avg=%f" % (self.x, self.y, self.z, self.np, self.average)
+
+    def __lt__(self, other):
+        return self.z < other.z
+
+    def __eq__(self, other):
+        if abs(self.z - other.z) <= self.frame_tolerance:
+            if (self.x - other.x)**2 + (self.y - other.y)**2 <= self.pixel_tolerance:
+                return True
+            else:
+                return False
+        else:
+            return False
+
+    def __ne__(self, other):
+        if abs(self.z - other.z) > self.frame_tolerance:
+            if (self.x - other.x)**2 + (self.y - other.y)**2 > self.pixel_tolerance:
+                return True
+            else:
+                return False
+        else:
+            return False
+
+    def combine(self, other):
+        self.peaks.extend(other.peaks)
+        self.combined = True
+        other.combined = False
+
+    def merge(self):
+        np = sum([p.np for p in self.peaks])
+        intensity = sum([p.intensity for p in self.peaks])
+        self.x = sum([p.x * p.intensity for p in self.peaks]) / intensity
+        self.y = sum([p.y * p.intensity for p in self.peaks]) /intensity
+        self.z = sum([p.z * p.intensity for p in self.peaks]) / intensity
+        self.sigx = sum([p.sigx * p.intensity for p in self.peaks]) / intensity
+        self.sigy = sum([p.sigy * p.intensity for p in self.peaks]) / intensity
+        self.covxy = sum([p.covxy * p.intensity for p in self.peaks]) / intensity
+        self.np = np
+        self.intensity = intensity
+        self.average = self.intensity / self.np
+
+    def isvalid(self, mask):
+        if mask is not None:
+            clip = mask[int(self.y),int(self.x)]
+            if clip:
+                return False
+        if np.isclose(self.average, 0.0) or np.isnan(self.average) or self.np < 5:
+            return False
+        else:
+            return True
+
+
+def peak_table(res, omega=None):
+    """Return the properties of blobs needed to define peaks as an array.
+
+    The blob properties returned by the connectedpixels extension are
+    converted into an array with columns for the number of pixels, average
+    intensity, x, y, z, sigx, sigy and covxy of each blob. If the omega
+    value of a 2D blob is not given, z is set to the intensity-weighted
+    omega of the (3D) blob.
+    """
+    table = np.empty((res.shape[0], 8), dtype=np.float64)
+    table[:,0] = res[:,s_1]
+    table[:,1] = res[:,avg_i]
+    table[:,2] = res[:,f_raw]
+    table[:,3] = res[:,s_raw]
+    if omega is None:
+        table[:,4] = res[:,o_raw]
+    else:
+        table[:,4] = omega
+    table[:,5] = res[:,m_ff]
+    table[:,6] = res[:,m_ss]
+    table[:,7] = res[:,m_sf]
+    return table
+
+
+def valid_peaks(table, mask=None):
+    """Return a boolean array of the rows in the peak table to be kept.
+
+    This is the array equivalent of NXpeak.isvalid.
+    """
+    npixels, average = table[:,0], table[:,1]
+    valid = ((npixels >= 5) & np.logical_not(np.isclose(average, 0.0)) &
+             np.logical_not(np.isnan(average)))
+    if mask is not None:
+        rows = np.flatnonzero(valid)
+        x = table[rows,2].astype(np.int64)
+        y = table[rows,3].astype(np.int64)
+        valid[rows] = np.logical_not(mask[y,x].astype(bool))
+    return valid
+
+
+def merge_peaks(table, threshold, pixel_tolerance, frame_tolerance,
+                z_min, z_max):
+    """Merge the 2D blobs in a peak table into a list of 3D peaks.
+
+    The blobs are processed in frame order. Each blob is combined with the
+    first existing peak whose most recent blob lies within the pixel and
+    frame tolerances, or starts a new peak. Candidate peaks are found using
+    a grid hash over x and y, which only contains peaks updated within the
+    last 'frame_tolerance' frames, so the merge scales as O(N log N) rather
+    than as the square of the number of blobs. The result is identical to
+    the original pairwise comparison of NXpeak instances.
+
+    Parameters
+    ----------
+    table : ndarray
+        Array of blob properties returned by 'peak_table'.
+    threshold : float
+        Threshold used in the peak search.
+    pixel_tolerance : float
+        Maximum separation of blobs in the same peak (in pixels).
+    frame_tolerance : float
+        Maximum separation of blobs in the same peak (in frames).
+    z_min, z_max : int
+        Range of frames to be merged (inclusive).
+
+    Returns
+    -------
+    list of NXpeak
+        Merged peaks sorted by their intensity-weighted frame number.
+    """
+    order = np.argsort(table[:,4], kind='mergesort')
+    table = table[order]
+    x, y, z = table[:,2], table[:,3], table[:,4]
+    in_range = (z >= z_min) & (z < z_max+1)
+    table, x, y, z = table[in_range], x[in_range], y[in_range], z[in_range]
+    nblobs = len(table)
+
+    tolerance = pixel_tolerance**2
+    cell_size = max(float(pixel_tolerance), 1.0)
+    cx = np.floor(x / cell_size).astype(np.int64)
+    cy = np.floor(y / cell_size).astype(np.int64)
+
+    labels = np.empty(nblobs, dtype=np.int64)
+    last = np.full(nblobs, -1, dtype=np.int64)
+    grid = {}
+    npeaks = 0
+    frames = np.flatnonzero(np.diff(z)) + 1
+    starts = np.concatenate(([0], frames))
+    stops = np.concatenate((frames, [nblobs]))
+    last_frame = {}
+
+    def close(b, c):
+        return (abs(z[b] - z[c]) <= frame_tolerance and
+                (x[b] - x[c])**2 + (y[b] - y[c])**2 <= tolerance)
+
+    def neighbors(b):
+        return [(i, j) for i in (cx[b]-1, cx[b], cx[b]+1)
+                       for j in (cy[b]-1, cy[b], cy[b]+1)]
+
+    def move(peak, b):
+        c = last[peak]
+        if c >= 0 and peak in grid.get((cx[c], cy[c]), []):
+            grid[(cx[c], cy[c])].remove(peak)
+        last[peak] = b
+        grid.setdefault((cx[b], cy[b]), []).append(peak)
+
+    def frame_grid(start, stop):
+        cells = {}
+        for c in range(start, stop):
+            cells.setdefault((cx[c], cy[c]), []).append(c)
+        return cells
+
+    for start, stop in zip(starts, stops):
+        if npeaks == 0:
+            for b in range(start, stop):
+                labels[b] = b - start
+                move(b - start, b)
+            npeaks = stop - start
+            last_frame = frame_grid(start, stop)
+            continue
+        for b in range(start, stop):
+            match = None
+            for key in neighbors(b):
+                cell = grid.get(key)
+                if not cell:
+                    continue
+                stale = [p for p in cell
+                         if z[last[p]] < z[b] - frame_tolerance]
+                for p in stale:
+                    cell.remove(p)
+                for p in cell:
+                    if (match is None or p < match) and close(b, last[p]):
+                        match = p
+            if match is None:
+                #A blob close to a peak in the previous frame, whose own peak
+                #has since moved on, is added to the most recent peak.
+                if any(close(b, c) for key in neighbors(b)
+                       for c in last_frame.get(key, [])):
+                    match = npeaks - 1
+                else:
+                    match = npeaks
+                    npeaks += 1
+            move(match, b)
+            labels[b] = match
+        last_frame = frame_grid(start, stop)
+
+    #Sums are accumulated with the most recent blobs first, as in NXpeak.merge
+    labels, table = labels[::-1], table[::-1]
+    intensity = table[:,0] * table[:,1]
+    weights = np.bincount(labels, weights=intensity, minlength=npeaks)
+    merged = np.empty((npeaks, 8), dtype=np.float64)
+    merged[:,0] = np.bincount(labels, weights=table[:,0], minlength=npeaks)
+    for col in range(2, 8):
+        merged[:,col] = np.bincount(labels, weights=table[:,col]*intensity,
+                                    minlength=npeaks) / weights
+    merged[:,1] = weights / merged[:,0]
+
+    order = np.argsort(z[last[:npeaks]], kind='mergesort')
+    order = order[np.argsort(merged[order,4], kind='mergesort')]
+    peaks = []
+    for k in order:
+        peak = NXpeak(merged[k,0], merged[k,1], merged[k,2], merged[k,3],
+                      merged[k,4], merged[k,5], merged[k,6], merged[k,7],
+                      threshold, pixel_tolerance, frame_tolerance)
+        peak.intensity = weights[k]
+        peaks.append(peak)
+    return peaks
+
+
+def search_block(filename, path, threshold, first, last, z_min, z_max,
+                 search3d=False):
+    """Return the table of peaks found in frames first to last-1 of a file.
+
+    This is run by each process of a parallel peak search over frames z_min
+    to z_max-1. In 3D mode, the search starts one frame before the block,
+    so that peaks crossing the lower boundary can be recognized and
+    discarded, and continues past the end of the block, up to z_max, until
+    all the peaks that start within it are complete. The 2D blobs or 3D
+    peaks from consecutive blocks can then be combined to give the same
+    result as a serial search.
+    """
+    with h5.File(filename, 'r') as f:
+        reader = NXReader(f, path)
+        search = NXPeakSearch(reader.shape[-2:], threshold, search3d=search3d,
+                              first=first, last=last)
+        if search3d and first > z_min:
+            start = first - 1
+        else:
+            start = first
+        for i in search.search_frames(reader, start, last, limit=z_max):
+            pass
+    return search.get_table()
@@ -0,0 +1,203 @@
+import queue
+import threading
+import numpy as np
+import h5py as h5
+
+
+class NXReader(object):
+    """Read a 3D HDF5 dataset of detector frames in chunk-aligned slabs.
+
+    The number of frames in each slab is a multiple of the number of frames
+    in each HDF5 chunk, chosen so that a slab contains about 'slab_bytes',
+    and the slab boundaries are aligned with the chunk boundaries, so that
+    no chunk is read, and possibly decompressed, more than once. If the
+    dataset is compressed, the dataset is reopened with a chunk cache that
+    is large enough to hold a complete layer of chunks spanning the
+    detector, in case the frames are read in smaller blocks. HDF5 only
+    applies the cache settings when a dataset is first opened, so the
+    dataset is specified by its parent group and path.
+
+    If 'prefetch' is greater than 0, that number of slabs are read ahead by
+    a background thread. By default, each slab is only read when it is
+    requested, since h5py holds the GIL while reading and decompressing
+    chunks, so reading ahead is only useful when the slabs are processed
+    by code that releases the GIL.
+
+    The slabs are read directly into preallocated buffers, which are reused
+    for subsequent slabs, so each array is only valid until the next slab
+    is requested and only one slab iterator should be active at a time.
+    """
+
+    slab_bytes = 2**28
+    prefetch = 0
+
+    def __init__(self, group, path, slab_bytes=None, prefetch=None):
+        data = group[path]
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.chunks = data.chunks
+        self.compression = data.compression
+        self.filtered = bool(self.chunks) and (data.compression is not None
+                                               or data.shuffle
+                                               or data.scaleoffset is not None
+                                               or data.fletcher32)
+        if slab_bytes is not None:
+            self.slab_bytes = slab_bytes
+        if prefetch is not None:
+            self.prefetch = prefetch
+        if self.chunks:
+            self.chunk_frames = self.chunks[0]
+        else:
+            self.chunk_frames = 1
+        frame_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+        layer_bytes = max(self.chunk_frames * frame_bytes, 1)
+        self.slab_frames = (max(self.slab_bytes // layer_bytes, 1) *
+                            self.chunk_frames)
+        self._buffers = []
+        self.file = data.file
+        self.name = data.name
+        del data
+        self.data = self.open()
+
+    def cache_settings(self):
+        """Return the number of slots and bytes of the dataset chunk cache.
+
+        The cache holds one layer of chunks, i.e., all the chunks that
+        contain a single frame. The number of slots is a prime number about
+        a hundred times larger than the number of chunks in the cache, as
+        recommended by the HDF5 documentation.
+        """
+        chunk_bytes = int(np.prod(self.chunks)) * self.dtype.itemsize
+        nchunks = int(np.prod([np.ceil(s / c) for s, c
+                               in zip(self.shape[1:], self.chunks[1:])]))
+        return next_prime(100 * nchunks), nchunks * chunk_bytes
+
+    def open(self):
+        """Return the dataset opened with a chunk cache sized for the slabs.
+
+        Uncompressed chunks that are larger than the cache are read
+        directly into the output array by HDF5, so the cache is only
+        resized when the chunks have to be decompressed.
+        """
+        if not self.filtered:
+            return self.file[self.name]
+        nslots, nbytes = self.cache_settings()
+        dapl = h5.h5p.create(h5.h5p.DATASET_ACCESS)
+        dapl.set_chunk_cache(nslots, nbytes, 1.0)
+        return h5.Dataset(h5.h5d.open(self.file.id, self.name.encode('utf-8'),
+                                      dapl=dapl))
+
+    def slabs(self, first=0, last=None, frames=None, prefetch=None):
+        """Yield the frames from first to last-1 as (start, stop, array).
+
+        Each slab, apart from the first and last, contains 'frames' frames,
+        which defaults to the planned slab size and is rounded up to a
+        multiple of the chunk size. If 'prefetch' is greater than 0, up to
+        that number of slabs are read ahead in a background thread.
+        """
+        if last is None or last > self.shape[0]:
+            last = self.shape[0]
+        if frames is None:
+            frames = self.slab_frames
+        else:
+            frames = (int(np.ceil(frames / self.chunk_frames)) *
+                      self.chunk_frames)
+        if prefetch is None:
+            prefetch = self.prefetch
+        plan = []
+        i = first
+        while i < last:
+            j = min((i // frames + 1) * frames, last)
+            plan.append((i, j))
+            i = j
+        if not plan:
+            return
+        size = max(j-i for (i, j) in plan)
+        if prefetch > 0 and len(plan) > 1:
+            yield from self.prefetched(plan, prefetch, size)
+        else:
+            buffer = self.buffers(1, size)[0]
+            for i, j in plan:
+                yield i, j, self.read(i, j, out=buffer)
+
+    def prefetched(self, plan, depth, size):
+        """Yield the planned slabs, while a thread reads the following slabs.
+
+        h5py holds the GIL while HDF5 reads and decompresses the data, so
+        the reads only overlap with processing that releases the GIL, such
+        as large numpy operations or the C peak search, and do not speed up
+        pure Python processing. If the generator is closed early, the thread
+        is stopped after its current read. Any exception raised by the
+        thread is raised again by the generator.
+
+        Besides the 'depth' slabs in the queue, one buffer is being read by
+        the thread and one is being processed, so a buffer is never
+        overwritten before the following slab has been requested.
+        """
+        buffers = self.buffers(depth+2, size)
+        slabs = queue.Queue(maxsize=depth)
+        stopped = threading.Event()
+        def read_ahead():
+            try:
+                for k, (i, j) in enumerate(plan):
+                    if stopped.is_set():
+                        break
+                    slabs.put((i, j, self.read(i, j,
+                                               out=buffers[k % len(buffers)])))
+            except Exception as error:
+                slabs.put(error)
+            slabs.put(None)
+        thread = threading.Thread(target=read_ahead, daemon=True)
+        thread.start()
+        try:
+            while True:
+                slab = slabs.get()
+                if slab is None:
+                    break
+                elif isinstance(slab, Exception):
+                    raise slab
+                yield slab
+        finally:
+            stopped.set()
+            while thread.is_alive():
+                try:
+                    slabs.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    def buffers(self, number, frames):
+        """Return a number of slab buffers that can hold at least 'frames'.
+
+        The buffers are retained, so that they can be reused by later
+        iterators, and are only reallocated if more or larger buffers are
+        required.
+        """
+        if (len(self._buffers) < number or
+                self._buffers[0].shape[0] < frames):
+            if self._buffers:
+                frames = max(frames, self._buffers[0].shape[0])
+            self._buffers = [np.empty((frames,)+self.shape[1:],
+                                      dtype=self.dtype)
+                             for _ in range(max(number, len(self._buffers)))]
+        return self._buffers[:number]
+
+    def read(self, start, stop, out=None):
+        """Return frames start to stop-1, read into 'out' if it is given.
+
+        If a buffer is given, it must have at least stop-start frames and
+        the returned array is a view of its leading frames.
+        """
+        if out is None:
+            return self.data[start:stop]
+        slab = out[:stop-start]
+        self.data.read_direct(slab, np.s_[start:stop])
+        return slab
+
+
+def next_prime(n):
+    """Return the smallest prime number that is not less than n"""
+    n = max(n, 2)
+    while any(n % i == 0 for i in range(2, int(np.sqrt(n)) + 1)):
+        n += 1
+    return n
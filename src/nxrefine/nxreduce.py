@@ -2,12 +2,12 @@ import logging, logging.handlers
 import os
 import errno
 import platform
-import shutil
 import subprocess
 import sys
 import time
 import timeit
 import datetime
+import zlib
 import numpy as np
 import h5py as h5
 from h5py import is_hdf5
@@ -19,11 +19,13 @@ from nexpy.gui.utils import timestamp
 
 import nxrefine.nxdatabase as nxdb
 from .nxrefine import NXRefine
+from .nxtransformer import (NXTransformer, peak_mask, read_peak_mask,
+                            sum_transforms, transform_block)
 from .nxlock import Lock
+from .nxreader import NXReader
 from .nxserver import NXServer
 from . import blobcorrector, __version__
-from .connectedpixels import blob_moments
-from .labelimage import labelimage, flip1
+from .nxpeaks import NXPeakSearch, NXpeak, merge_peaks, search_block
 
 
 class NXReduce(QtCore.QObject):
@@ -31,10 +33,11 @@ class NXReduce(QtCore.QObject):
     def __init__(self, entry='f1', directory=None, parent=None, entries=None,
                  data='data/data', extension='.h5', path='/entry/data/data',
                  threshold=None, first=None, last=None, radius=None, width=None,
-                 norm=None, Qh=None, Qk=None, Ql=None, 
-                 link=False, maxcount=False, find=False, copy=False,
-                 refine=False, lattice=False, transform=False, mask=False,
-                 overwrite=False, gui=False):
+                 norm=None, Qh=None, Qk=None, Ql=None, search3d=False,
+                 workers=1, prefetch=0, fused=False, backend='cctw',
+                 jacobian=False, linear=False, link=False, maxcount=False,
+                 find=False, copy=False, refine=False, lattice=False,
+                 transform=False, mask=False, overwrite=False, gui=False):
 
         super(NXReduce, self).__init__()
 
@@ -110,6 +113,13 @@ class NXReduce(QtCore.QObject):
         self.Qh = Qh
         self.Qk = Qk
         self.Ql = Ql
+        self.search3d = search3d
+        self.workers = workers
+        self.prefetch = prefetch
+        self.fused = fused
+        self.backend = backend
+        self.jacobian = jacobian
+        self.linear = linear
 
         self.link = link
         self.maxcount = maxcount
@@ -303,14 +313,7 @@ class NXReduce(QtCore.QObject):
     def threshold(self):
         _threshold = self._threshold
         if _threshold is None:
-            if 'peaks' in self.entry and 'threshold' in self.entry['peaks'].attrs:
-                _threshold = np.int32(self.entry['peaks'].attrs['threshold'])
-            elif self.parent:
-                with Lock(self.parent):
-                    root = nxload(self.parent)
-                    if ('peaks' in root[self.entry_name] and
-                        'threshold' in root[self.entry_name]['peaks'].attrs):
-                        _threshold = np.int32(root[self.entry_name]['peaks'].attrs['threshold'])
+            _threshold = self.saved_threshold()
         if _threshold is None:
             if self.maximum is not None:
                 _threshold = self.maximum / 10
@@ -326,6 +329,19 @@ class NXReduce(QtCore.QObject):
     def threshold(self, value):
         self._threshold = value
 
+    def saved_threshold(self):
+        """Return the threshold saved in the entry or parent file, if any"""
+        _threshold = None
+        if 'peaks' in self.entry and 'threshold' in self.entry['peaks'].attrs:
+            _threshold = np.int32(self.entry['peaks'].attrs['threshold'])
+        elif self.parent:
+            with Lock(self.parent):
+                root = nxload(self.parent)
+                if ('peaks' in root[self.entry_name] and
+                    'threshold' in root[self.entry_name]['peaks'].attrs):
+                    _threshold = np.int32(root[self.entry_name]['peaks'].attrs['threshold'])
+        return _threshold
+
     @property
     def radius(self):
         _radius = self._radius
@@ -619,35 +635,29 @@ class NXReduce(QtCore.QObject):
         self.logger.info('Finding maximum counts')
         maximum = 0.0
         nframes = self.shape[0]
-        chunk_size = self.field.chunks[0]
-        if chunk_size < 20:
-            chunk_size = 50
-        data = self.field.nxfile[self.path]
+        reader = self.reader()
         if self.first == None:
             self.first = 0
         if self.last == None:
             self.last = nframes
         tic = self.start_progress(self.first, self.last)
         fsum = np.zeros(self.entry['data'].nxaxes[0].shape, dtype=np.float64)
-        for i in range(self.first, self.last, chunk_size):
+        pool = self.statistics_pool()
+        for i, j, v in reader.slabs(self.first, self.last):
             if self.stopped:
+                self.stop_statistics_pool(pool)
                 return None
             self.update_progress(i)
-            try:
-                v = data[i:i+chunk_size,:,:]
-            except IndexError as error:
-                pass
+            s, m, f = chunk_statistics(v, pool, self.workers)
             if i == self.first:
-                vsum = v.sum(0)
+                vsum, vmax = s, m
             else:
-                vsum += v.sum(0)
-            fsum[i:i+chunk_size] = v.sum((1,2))
-            if self.pixel_mask is not None:
-                v = np.ma.masked_array(v)
-                v.mask = self.pixel_mask
-            if maximum < v.max():
-                maximum = v.max()
+                vsum += s
+                np.maximum(vmax, m, out=vmax)
+            fsum[i:j] = f
             del v
+        self.stop_statistics_pool(pool)
+        maximum = self.masked_maximum(vmax, maximum)
         if self.pixel_mask is not None:
             vsum = np.ma.masked_array(vsum)
             vsum.mask = self.pixel_mask
@@ -657,6 +667,34 @@ class NXReduce(QtCore.QObject):
         self.logger.info('Maximum counts: %s (%g seconds)' % (maximum, toc-tic))
         return maximum
 
+    def reader(self):
+        """Return an NXReader to read the raw data in chunk-aligned slabs.
+
+        If 'prefetch' is greater than 0, that number of slabs are read ahead
+        by a background thread.
+        """
+        return NXReader(self.field.nxfile, self.path, prefetch=self.prefetch)
+
+    def statistics_pool(self):
+        """Return a thread pool for the chunk statistics, if needed."""
+        if self.workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            return ThreadPoolExecutor(self.workers)
+        else:
+            return None
+
+    def stop_statistics_pool(self, pool):
+        if pool is not None:
+            pool.shutdown()
+
+    def masked_maximum(self, vmax, maximum=0.0):
+        """Return the larger of the current and unmasked per-pixel maxima."""
+        if self.pixel_mask is not None:
+            vmax = vmax[np.logical_not(self.pixel_mask)]
+        if vmax.size > 0 and maximum < vmax.max():
+            maximum = vmax.max()
+        return maximum
+
     def write_maximum(self, maximum):
         self.entry['data'].attrs['maximum'] = maximum
         self.entry['data'].attrs['first'] = self.first
@@ -669,6 +707,44 @@ class NXReduce(QtCore.QObject):
             del self.entry['summed_frames']
         self.entry['summed_frames'] = NXdata(self.summed_frames,
                                              self.entry['data'].nxaxes[0])
+        try:
+            counts = self.entry['summed_data/summed_data'].nxvalue
+            polar_angle, intensity, corrected = self.radial_sum(counts, 2048)
+            if 'radial_sum' in self.entry:
+                del self.entry['radial_sum']
+            self.entry['radial_sum'] = NXdata(
+                NXfield(intensity, name='radial_sum'),
+                NXfield(polar_angle, name='polar_angle'))
+            self.entry['radial_sum'].attrs['solid_angle_correction'] = (
+                corrected)
+            if corrected:
+                self.logger.info('Radial sum created with pyFAI')
+            else:
+                self.logger.info(
+                    'Radial sum created from the detector geometry maps '
+                    'without a solid angle correction')
+        except Exception as error:
+            self.logger.info('Unable to create radial sum')
+        self.record('nxmax', maximum=maximum,
+                    first_frame=self.first, last_frame=self.last)
+
+    def geometry_defined(self):
+        """Return True if the detector geometry has been set in the entry"""
+        return all(path in self.entry for path in
+                   ['instrument/monochromator/wavelength',
+                    'instrument/detector/distance',
+                    'instrument/detector/beam_center_x',
+                    'instrument/detector/beam_center_y'])
+
+    def radial_sum(self, counts, bins):
+        """Return the polar angles, mean counts and solid angle correction.
+
+        If pyFAI or its calibration is not available, the cached per-pixel
+        geometry maps are used instead, without a solid angle correction,
+        provided the detector geometry has already been set. The last
+        value returned is True if the counts were corrected for the solid
+        angle.
+        """
         try:
             from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
             parameters = self.entry['instrument/calibration/refinement/parameters']
@@ -681,20 +757,29 @@ class NXReduce(QtCore.QObject):
                                        pixel1=parameters['PixelSize1'].nxvalue,
                                        pixel2=parameters['PixelSize2'].nxvalue,
                                        wavelength = parameters['Wavelength'].nxvalue)
-            counts = self.entry['summed_data/summed_data'].nxvalue
-            polar_angle, intensity = cake.integrate1d(counts, 2048,
+            polar_angle, intensity = cake.integrate1d(counts, bins,
                                                       unit='2th_deg',
                                                       mask=self.pixel_mask,
                                                       correctSolidAngle=True)
-            if 'radial_sum' in self.entry:
-                del self.entry['radial_sum']
-            self.entry['radial_sum'] = NXdata(
-                NXfield(intensity, name='radial_sum'),
-                NXfield(polar_angle, name='polar_angle'))
-        except Exception as error:
-            self.logger.info('Unable to create radial sum')
-        self.record('nxmax', maximum=maximum,
-                    first_frame=self.first, last_frame=self.last)
+            return polar_angle, intensity, True
+        except (ImportError, NeXusError):
+            pass
+        if not self.geometry_defined():
+            raise NeXusError('Detector geometry has not been set')
+        refine = NXRefine(self.entry)
+        polar_angles = refine.geometry_maps(counts.shape)[0]
+        if self.pixel_mask is not None:
+            valid = np.logical_not(self.pixel_mask)
+        else:
+            valid = np.ones(counts.shape, dtype=bool)
+        polar_angles, counts = polar_angles[valid], counts[valid]
+        edges = np.linspace(polar_angles.min(), polar_angles.max(), bins+1)
+        idx = np.clip(np.digitize(polar_angles, edges) - 1, 0, bins-1)
+        sums = np.bincount(idx, weights=counts, minlength=bins)
+        pixels = np.bincount(idx, minlength=bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            intensity = np.where(pixels > 0, sums / pixels, 0.0)
+        return 0.5 * (edges[1:] + edges[:-1]), intensity, False
 
     def nxfind(self):
         if self.not_complete('nxfind') and self.find:
@@ -730,102 +815,46 @@ class NXReduce(QtCore.QObject):
 
         tic = self.start_progress(z_min, z_max)
 
-        lio = labelimage(self.shape[-2:], flipper=flip1)
-        allpeaks = []
-        if len(self.shape) == 2:
-            res = None
-        else:
-            chunk_size = self.field.chunks[0]
-            pixel_tolerance = 50
-            frame_tolerance = 10
-            nframes = z_max
-            data = self.field.nxfile[self.path]
-            for i in range(0, nframes, chunk_size):
-                if self.stopped:
-                    return None
-                try:
-                    if i + chunk_size > z_min and i < z_max:
-                        self.update_progress(i)
-                        v = data[i:i+chunk_size,:,:]
-                        for j in range(chunk_size):
-                            if i+j >= z_min and i+j <= z_max:
-                                omega = np.float32(i+j)
-                                lio.peaksearch(v[j], self.threshold, omega)
-                                if lio.res is not None:
-                                    blob_moments(lio.res)
-                                    for k in range(lio.res.shape[0]):
-                                        res = lio.res[k]
-                                        peak = NXpeak(res[0], res[22],
-                                            res[23], res[24], omega,
-                                            res[27], res[26], res[29],
-                                            self.threshold,
-                                            pixel_tolerance,
-                                            frame_tolerance)
-                                        if peak.isvalid(self.pixel_mask):
-                                            allpeaks.append(peak)
-                except IndexError as error:
-                    pass
+        search = NXPeakSearch(self.shape[-2:], self.threshold,
+                              mask=self.pixel_mask, search3d=self.search3d)
+        if len(self.shape) == 3:
+            if self.workers > 1:
+                chunk_size = self.reader().chunk_frames
+                from multiprocessing import Pool
+                block_size = int(np.ceil((z_max - z_min) /
+                                         (4 * self.workers * chunk_size)))
+                block_size = max(block_size, 1) * chunk_size
+                blocks = [(i, min(i+block_size, z_max))
+                          for i in range(z_min, z_max, block_size)]
+                self.logger.info('Searching %s blocks with %s workers'
+                                 % (len(blocks), self.workers))
+                with Pool(self.workers) as pool:
+                    results = [pool.apply_async(search_block,
+                                                (self.data_file, self.path,
+                                                 self.threshold, first, last,
+                                                 z_min, z_max, self.search3d))
+                               for (first, last) in blocks]
+                    for (first, last), result in zip(blocks, results):
+                        if self.stopped:
+                            return None
+                        self.update_progress(first)
+                        search.add_table(result.get())
+            else:
+                for i in search.search_frames(self.reader(), z_min, z_max):
+                    if self.stopped:
+                        return None
+                    self.update_progress(i)
 
-        if not allpeaks:
-            toc = self.stop_progress()
+        peaks = search.get_peaks(z_min, z_max)
+        toc = self.stop_progress()
+        if not peaks:
             self.logger.info('No peaks found (%g seconds)' % (toc-tic))
             return None
-
-        allpeaks = sorted(allpeaks)
-
-        self.start_progress(z_min, z_max)
-
-        merged_peaks = []
-        for z in range(z_min, z_max+1):
-            if self.stopped:
-                return None
-            self.update_progress(z)
-            frame = [peak for peak in allpeaks if peak.z == z]
-            if not merged_peaks:
-                merged_peaks.extend(frame)
-            else:
-                for peak1 in frame:
-                    combined = False
-                    for peak2 in last_frame:
-                        if peak1 == peak2:
-                            for idx in range(len(merged_peaks)):
-                                if peak1 == merged_peaks[idx]:
-                                    break
-                            peak1.combine(merged_peaks[idx])
-                            merged_peaks[idx] = peak1
-                            combined = True
-                            break
-                    if not combined:
-                        reversed_peaks = [p for p in reversed(merged_peaks)
-                                          if p.z >= peak1.z - frame_tolerance]
-                        for peak2 in reversed_peaks:
-                            if peak1 == peak2:
-                                for idx in range(len(merged_peaks)):
-                                    if peak1 == merged_peaks[idx]:
-                                        break
-                                peak1.combine(merged_peaks[idx])
-                                merged_peaks[idx] = peak1
-                                combined = True
-                                break
-                        if not combined:
-                            merged_peaks.append(peak1)
-
-            if frame:
-                last_frame = frame
-
-        merged_peaks = sorted(merged_peaks)
-        for peak in merged_peaks:
-            peak.merge()
-
-        merged_peaks = sorted(merged_peaks)
-        peaks = merged_peaks
-        toc = self.stop_progress()
         self.logger.info('%s peaks found (%g seconds)' % (len(peaks), toc-tic))
         return peaks
 
     def write_peaks(self, peaks):
         group = NXreflections()
-        shape = (len(peaks),)
         group['npixels'] = NXfield([peak.np for peak in peaks], dtype=np.float32)
         group['intensity'] = NXfield([peak.intensity for peak in peaks],
                                         dtype=np.float32)
@@ -845,9 +874,133 @@ class NXReduce(QtCore.QObject):
         polar_angles, azimuthal_angles = refine.calculate_angles(refine.xp,
                                                                  refine.yp)
         refine.write_angles(polar_angles, azimuthal_angles)
+        if self.search3d:
+            search = '3D connected pixels'
+        else:
+            search = '2D connected pixels'
         self.record('nxfind', threshold=self.threshold,
                     first_frame=self.first, last_frame=self.last,
-                    peak_number=len(peaks))
+                    peak_number=len(peaks), search=search)
+
+    def nxmax_and_find(self):
+        """Find the maximum counts and the peaks with a single read of the data.
+
+        This is only used if both tasks are still to be completed. Otherwise,
+        nxmax and nxfind are run separately.
+        """
+        if (self.gui or not (self.maxcount and self.find) or
+                not (self.not_complete('nxmax') and
+                     self.not_complete('nxfind'))):
+            self.nxmax()
+            self.nxfind()
+            return
+        if not self.data_exists():
+            self.logger.info('Data file not available')
+            return
+        self.record_start('nxmax')
+        self.record_start('nxfind')
+        with Lock(self.data_file):
+            maximum, peaks = self.find_maximum_and_peaks()
+        if maximum is None:
+            return
+        with Lock(self.wrapper_file):
+            self.write_maximum(maximum)
+            if peaks is not None:
+                self.write_peaks(peaks)
+            else:
+                self.record('nxfind', threshold=self.threshold,
+                            first_frame=self.first, last_frame=self.last,
+                            peak_number=0)
+
+    def find_maximum_and_peaks(self):
+        """Return the maximum counts and the peaks in frames first to last-1.
+
+        Each chunk of data is read once and used to accumulate the maximum
+        counts, the summed data and frames, and the peak search. If the
+        threshold has been neither specified nor saved in the entry or
+        parent file, it is set to a tenth of the final maximum, as in
+        separate nxmax and nxfind runs. In that case, the pixels in each
+        frame that are above a tenth of the current maximum are stored, and
+        pruned whenever the maximum increases, so the peak search can be
+        replayed from memory once the final threshold is known.
+        """
+        self.logger.info('Finding maximum counts and peaks')
+        maximum = 0.0
+        nframes = self.shape[0]
+        reader = self.reader()
+        if self.first == None:
+            self.first = 0
+        if self.last == None:
+            self.last = nframes
+        z_min, z_max = self.first, self.last
+        threshold = self._threshold
+        if threshold is None:
+            threshold = self.saved_threshold()
+        if threshold is not None and float(threshold) > 0.0:
+            threshold = self.threshold = float(threshold)
+        else:
+            threshold = None
+        if threshold is not None:
+            search = NXPeakSearch(self.shape[-2:], threshold,
+                                  mask=self.pixel_mask,
+                                  search3d=self.search3d)
+        pixels = []
+        level = 0.0
+        tic = self.start_progress(z_min, z_max)
+        vsum = np.zeros(self.shape[-2:], dtype=np.float64)
+        fsum = np.zeros(self.entry['data'].nxaxes[0].shape, dtype=np.float64)
+        pool = self.statistics_pool()
+        for i, stop, v in reader.slabs(z_min, z_max):
+            if self.stopped:
+                self.stop_statistics_pool(pool)
+                return None, None
+            self.update_progress(i)
+            s, m, f = chunk_statistics(v, pool, self.workers)
+            vsum += s
+            fsum[i:stop] = f
+            maximum = self.masked_maximum(m, maximum)
+            if threshold is not None:
+                for j in range(v.shape[0]):
+                    search.search(v[j], i+j)
+            else:
+                if maximum / 10 > 2 * level:
+                    level = maximum / 10
+                    pixels = [(idx[values > level], values[values > level])
+                              for (idx, values) in pixels]
+                for j in range(v.shape[0]):
+                    frame = v[j].ravel()
+                    idx = np.flatnonzero(frame > level)
+                    pixels.append((idx, frame[idx]))
+            del v
+        self.stop_statistics_pool(pool)
+        if self.pixel_mask is not None:
+            vsum = np.ma.masked_array(vsum)
+            vsum.mask = self.pixel_mask
+        self.summed_data = NXfield(vsum, name='summed_data')
+        self.summed_frames = NXfield(fsum, name='summed_frames')
+        self.logger.info('Maximum counts: %s' % maximum)
+
+        if threshold is None:
+            threshold = self.threshold = maximum / 10
+            search = NXPeakSearch(self.shape[-2:], threshold,
+                                  mask=self.pixel_mask,
+                                  search3d=self.search3d)
+            frame = np.zeros(np.prod(self.shape[-2:]), dtype=reader.dtype)
+            for j, (idx, values) in enumerate(pixels):
+                if self.stopped:
+                    return None, None
+                frame[idx] = values
+                search.search(frame.reshape(self.shape[-2:]), z_min+j)
+                frame[idx] = 0
+            del pixels
+
+        peaks = search.get_peaks(z_min, z_max)
+        toc = self.stop_progress()
+        if not peaks:
+            self.logger.info('No peaks found (%g seconds)' % (toc-tic))
+            return maximum, None
+        self.logger.info('%s peaks found (%g seconds)' % (len(peaks), toc-tic))
+        return maximum, peaks
 
     def nxcopy(self):
         if self.is_parent():
@@ -898,11 +1051,14 @@ class NXReduce(QtCore.QObject):
 
     def refine_parameters(self, lattice=False):
         refine = NXRefine(self.entry)
-        refine.refine_hkls(lattice=lattice, chi=True, omega=True)
+        refine.refine_hkls(lattice=lattice, chi=True, omega=True,
+                           jacobian=self.jacobian)
         fit_report=refine.fit_report
-        refine.refine_hkls(chi=True, omega=True, phi=True)
+        refine.refine_hkls(chi=True, omega=True, phi=True,
+                           jacobian=self.jacobian)
         fit_report = fit_report + '\n' + refine.fit_report
-        refine.refine_orientation_matrix()
+        refine.refine_orientation_matrix(jacobian=self.jacobian,
+                                         linear=self.linear)
         fit_report = fit_report + '\n' + refine.fit_report
         if refine.result.success:
             refine.fit_report = fit_report
@@ -924,7 +1080,9 @@ class NXReduce(QtCore.QObject):
             self.record_start('nxtransform')
             with Lock(self.wrapper_file):
                 cctw_command = self.prepare_transform()
-            if cctw_command:
+            if cctw_command and self.backend == 'native':
+                self.native_transform()
+            elif cctw_command:
                 self.logger.info('Transform process launched')
                 tic = timeit.default_timer()
                 with Lock(self.data_file):
@@ -1013,6 +1171,116 @@ class NXReduce(QtCore.QObject):
             self.logger.info('Invalid HKL grid')
             return None
 
+    def native_transform(self, mask=False):
+        """Transform the data using the in-process transform engine.
+
+        This is an alternative to running 'cctw transform', using the same
+        geometry, HKL grid, masks and weights. The output file has the same
+        layout, so the links created by 'prepare_transform' are unchanged.
+        """
+        if mask:
+            task = 'nxmasked_transform'
+            transform_file = self.masked_transform_file
+            self.logger.info('Masked transform launched (native backend)')
+        else:
+            task = 'nxtransform'
+            transform_file = self.transform_file
+            self.logger.info('Transform launched (native backend)')
+        with Lock(self.wrapper_file):
+            transformer = self.get_transformer(mask=mask)
+        tic = self.start_progress(0, self.shape[0])
+        if self.workers > 1:
+            if not self.parallel_transform(transformer, transform_file, mask):
+                self.record_fail(task)
+                return
+        else:
+            with Lock(self.data_file):
+                for i in transformer.transform_frames(self.reader()):
+                    if self.stopped:
+                        self.record_fail(task)
+                        return
+                    self.update_progress(i)
+            transformer.write(transform_file)
+        toc = self.stop_progress()
+        self.logger.info('Transform completed (%g seconds)' % (toc-tic))
+        with Lock(self.wrapper_file):
+            if mask:
+                self.record(task, mask=self.mask_file, radius=self.radius,
+                            width=self.width, norm=self.norm,
+                            backend='native',
+                            oversampling=transformer.oversample)
+            else:
+                self.record(task, norm=self.norm, backend='native',
+                            oversampling=transformer.oversample)
+
+    def parallel_transform(self, transformer, transform_file, mask=False):
+        """Transform the data in separate processes for each slab of the grid.
+
+        The grid is split along the l axis, and each process transforms all
+        the frames into its own slab, so that the memory and the size of
+        the shard files do not grow with the number of workers. The shards
+        are then copied slab by slab into the transform file and removed.
+        """
+        from multiprocessing import Pool
+        nframes = self.shape[0]
+        nl = transformer.shape[0]
+        block_size = int(np.ceil(nl / self.workers))
+        blocks = [(l, min(l+block_size, nl))
+                  for l in range(0, nl, block_size)]
+        shard_files = [transform_file.replace('.nxs', '_%s.nxs' % i)
+                       for i in range(len(blocks))]
+        if mask:
+            mask_file = self.mask_file
+        else:
+            mask_file = None
+        transformer.data_mask = None
+        self.logger.info('Transforming %s slabs with %s workers'
+                         % (len(blocks), self.workers))
+        try:
+            with Lock(self.data_file):
+                with Pool(self.workers) as pool:
+                    results = [pool.apply_async(transform_block,
+                                                (transformer.slab(first, last),
+                                                 self.data_file, self.path,
+                                                 0, nframes, shard_file,
+                                                 mask_file))
+                               for (first, last), shard_file
+                               in zip(blocks, shard_files)]
+                    for k, result in enumerate(results):
+                        if self.stopped:
+                            return False
+                        result.get()
+                        self.update_progress(nframes * (k+1) // len(blocks))
+            for l in sum_transforms(shard_files, transform_file,
+                                    transformer.shape):
+                if self.stopped:
+                    return False
+        finally:
+            for shard_file in shard_files:
+                if os.path.exists(shard_file):
+                    os.remove(shard_file)
+        return True
+
+    def get_transformer(self, mask=False):
+        refine = NXRefine(self.entry)
+        refine.read_parameters()
+        refine.h_start, refine.h_step, refine.h_stop = self.Qh
+        refine.k_start, refine.k_step, refine.k_stop = self.Qk
+        refine.l_start, refine.l_step, refine.l_stop = self.Ql
+        refine.define_grid()
+        if 'monitor_weight' in self.data:
+            weights = self.data['monitor_weight'].nxvalue
+        else:
+            weights = None
+        if mask:
+            data_mask = read_peak_mask(self.mask_file)
+            if data_mask is None:
+                data_mask = nxload(self.mask_file, 'r')['entry/mask']
+        else:
+            data_mask = None
+        return NXTransformer(refine, pixel_mask=self.pixel_mask,
+                             data_mask=data_mask, weights=weights)
+
     def nxmasked_transform(self):
         if self.not_complete('nxmasked_transform') and self.mask:
             self.record_start('nxmasked_transform')
@@ -1020,7 +1288,9 @@ class NXReduce(QtCore.QObject):
                 self.calculate_mask()
                 refine = NXRefine(self.entry)
                 cctw_command = self.prepare_transform(mask=True)
-            if cctw_command:
+            if cctw_command and self.backend == 'native':
+                self.native_transform(mask=True)
+            elif cctw_command:
                 self.logger.info('Masked transform launched')
                 tic = timeit.default_timer()
                 with Lock(self.data_file):
@@ -1049,32 +1319,46 @@ class NXReduce(QtCore.QObject):
             self.record_end('nxmasked_transform')
 
     def calculate_mask(self):
+        """Calculate the 3D mask of discs around each peak.
+
+        The mask is stored in sparse form as the center, radius and frame
+        range of each disc, which is expanded one block of frames at a time
+        by the native transform. CCTW requires a dense mask, which is only
+        created, as 'entry/mask', when it is the transform backend. It is
+        written in gzip-compressed chunks, which CCTW can read with the
+        standard HDF5 library, one block of frames at a time.
+        """
         self.logger.info("Calculating 3D mask")
-        mask = np.zeros(shape=self.shape, dtype=np.bool)
-        x, y = np.arange(self.shape[2]), np.arange(self.shape[1])
-        xp, yp, zp = self.entry['peaks/x'], self.entry['peaks/y'], self.entry['peaks/z']
-        tic = self.start_progress(0, len(xp))
-        inside = np.array([(x[np.newaxis,:]-int(cx))**2 + 
-                          (y[:,np.newaxis]-int(cy))**2 < self.radius**2 
-                          for cx,cy in zip(xp,yp)], dtype=np.bool)
-        half_width = float(self.width) / 2.0
-        i, j = int(half_width-0.5), int(half_width+0.5) 
-        for k, frame in enumerate([int(z) for z in zp]):
-            if self.stopped:
-                return None
-            self.update_progress(frame)
-            mask[frame-i:frame+j] = mask[frame-i:frame+j] | inside[k]
+        xp, yp, zp = (self.entry['peaks/x'].nxvalue,
+                      self.entry['peaks/y'].nxvalue,
+                      self.entry['peaks/z'].nxvalue)
+        tic = self.start_progress(0, self.shape[0])
+        mask = peak_mask(self.shape, xp, yp, zp, self.radius, self.width)
         root = nxload(self.mask_file, 'w')
         if 'entry' not in root:
             root['entry'] = NXentry()
         entry = root['entry']
+        mask.save(entry)
         if 'mask' in entry:
             del entry['mask']
-        entry['mask'] = mask
-        mask_file = os.path.relpath(self.mask_file, os.path.dirname(self.wrapper_file))
         if 'data_mask' in self.data:
             del self.data['data_mask']
-        self.data['data_mask'] = NXlink('entry/mask', mask_file)
+        if self.backend == 'cctw':
+            if self.field.chunks:
+                chunk_size = self.field.chunks[0]
+            else:
+                chunk_size = 1
+            entry['mask'] = NXfield(shape=self.shape, dtype=bool,
+                                    chunks=(chunk_size,)+self.shape[1:],
+                                    compression='gzip', shuffle=False,
+                                    fillvalue=False)
+            for i in mask.write_frames(entry['mask'], chunk_size):
+                if self.stopped:
+                    return None
+                self.update_progress(i)
+            mask_file = os.path.relpath(self.mask_file,
+                                        os.path.dirname(self.wrapper_file))
+            self.data['data_mask'] = NXlink('entry/mask', mask_file)
         toc = self.stop_progress()
         self.logger.info("3D Mask stored in '%s' (%g seconds)"
                          % (self.mask_file, toc-tic))
@@ -1090,40 +1374,101 @@ class NXReduce(QtCore.QObject):
         else:
             self.logger.info('Data already summed')
 
-    def sum_files(self, scan_list):
-    
-        nframes = 3650
-        chunk_size = 50
-
-        for i, scan in enumerate(scan_list):
-            reduce = NXReduce(self.entry_name, 
+    def sum_files(self, scan_list, level=4):
+        """Sum the raw data of the same entry in each scan into a new file.
+
+        All the scan files are opened at once and each block of frames is
+        summed over the scans, in parallel if there is more than one worker.
+        The summed data are written to a new chunked dataset, compressed
+        with gzip at the given level, and the other contents of the first
+        scan file are copied to the new file. The file is written under a
+        temporary name, which only replaces the data file once the sum is
+        complete, so a stopped or failed sum leaves no partial file.
+        """
+        input_files = []
+        for scan in scan_list:
+            reduce = NXReduce(self.entry_name,
                               os.path.join(self.base_directory, scan))
             if not os.path.exists(reduce.data_file):
                 self.logger.info("'%s' does not exist" % reduce.data_file)
-                if i == 0:
-                    break
-                else:
-                    continue
             else:
-                self.logger.info("Summing %s in '%s'" % (self.entry_name,
-                                                         reduce.data_file))
-            with Lock(reduce.data_file):
-                if i == 0:
-                    shutil.copyfile(reduce.data_file, self.data_file)
-                    new_file = h5.File(self.data_file, 'r+')
-                    new_field = new_file[self.path]
+                input_files.append(reduce.data_file)
+        if not input_files:
+            self.logger.info('No files to sum')
+            return
+        with h5.File(input_files[0], 'r') as f:
+            reader = NXReader(f, self.path)
+            shape, dtype = reader.shape, reader.dtype
+            chunks = reader.chunks or (1,) + shape[1:]
+            block_size = reader.slab_frames
+        for input_file in input_files[1:]:
+            with h5.File(input_file, 'r') as f:
+                if f[self.path].shape != shape:
+                    self.logger.info("'%s' has the wrong shape" % input_file)
+                    input_files.remove(input_file)
+        for input_file in input_files:
+            self.logger.info("Summing %s in '%s'" % (self.entry_name,
+                                                     input_file))
+        nframes = shape[0]
+        blocks = [(i, min(i+block_size, nframes))
+                  for i in range(0, nframes, block_size)]
+        locks = [Lock(input_file) for input_file in input_files]
+        temp_file = self.data_file + '.tmp'
+        tic = self.start_progress(0, nframes)
+        try:
+            for lock in locks:
+                lock.acquire()
+            with h5.File(input_files[0], 'r') as f, \
+                 h5.File(temp_file, 'w') as output:
+                copy_except(f, output, self.path)
+                field = output.create_dataset(self.path, shape=shape,
+                                              dtype=dtype, chunks=chunks,
+                                              compression='gzip',
+                                              compression_opts=level)
+                for attr, value in f[self.path].attrs.items():
+                    field.attrs[attr] = value
+                if self.workers > 1:
+                    from multiprocessing import Pool
+                    self.logger.info('Summing %s blocks with %s workers'
+                                     % (len(blocks), self.workers))
+                    with Pool(self.workers) as pool:
+                        results = [pool.apply_async(sum_block,
+                                                     (input_files, self.path,
+                                                      first, last, chunks,
+                                                      level))
+                                   for (first, last) in blocks]
+                        for (first, last), result in zip(blocks, results):
+                            if self.stopped:
+                                return
+                            self.update_progress(first)
+                            for offset, chunk in result.get():
+                                field.id.write_direct_chunk(offset, chunk)
                 else:
-                    scan_file = h5.File(reduce.data_file, 'r')
-                    scan_field = scan_file[self.path]
-                    for i in range(0, nframes, chunk_size):
-                        new_slab = new_field[i:i+chunk_size,:,:]
-                        scan_slab = scan_field[i:i+chunk_size,:,:]
-                        new_field[i:i+chunk_size,:,:] = new_slab + scan_slab
+                    for first, last in blocks:
+                        if self.stopped:
+                            return
+                        self.update_progress(first)
+                        for offset, chunk in sum_block(input_files, self.path,
+                                                       first, last, chunks,
+                                                       level):
+                            field.id.write_direct_chunk(offset, chunk)
+            os.replace(temp_file, self.data_file)
+        finally:
+            for lock in locks:
+                lock.release()
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        toc = self.stop_progress()
+        self.logger.info('%s files summed (%g seconds)'
+                         % (len(input_files), toc-tic))
 
     def nxreduce(self):
         self.nxlink()
-        self.nxmax()
-        self.nxfind()
+        if self.fused:
+            self.nxmax_and_find()
+        else:
+            self.nxmax()
+            self.nxfind()
         self.nxcopy()
         if self.complete('nxcopy'):
             self.nxrefine()
@@ -1160,14 +1505,28 @@ class NXReduce(QtCore.QObject):
                 switches.append('-m')
             if self.find:
                 switches.append('-f')
+                if self.fused and self.maxcount:
+                    switches.append('-F')
+                if self.search3d:
+                    switches.append('-s')
             if self.copy:
                 switches.append('-c')
             if self.refine:
                 switches.append('-r')
+                if self.jacobian:
+                    switches.append('-J')
+                if self.linear:
+                    switches.append('-L')
             if self.transform:
                 switches.append('-t')
             if self.mask:
                 switches.append('-M')
+            if (self.transform or self.mask) and self.backend != 'cctw':
+                switches.append('-B %s' % self.backend)
+            if self.workers > 1 and (self.find or self.backend != 'cctw'):
+                switches.append('-w %s' % self.workers)
+            if self.prefetch > 0 and (self.maxcount or self.find):
+                switches.append('--prefetch %s' % self.prefetch)
             if len(switches) == 2:
                 return None
         if self.overwrite:
@@ -1202,9 +1561,10 @@ class NXReduce(QtCore.QObject):
 class NXMultiReduce(NXReduce):
 
     def __init__(self, directory, entries=['f1', 'f2', 'f3'], 
-                 mask=False, pdf=False, overwrite=False):
+                 mask=False, pdf=False, backend='cctw', overwrite=False):
         super(NXMultiReduce, self).__init__(entry='entry', directory=directory,
-                                            entries=entries, overwrite=overwrite)
+                                            entries=entries, backend=backend,
+                                            overwrite=overwrite)
         self.mask = mask
         self.pdf = pdf
 
@@ -1252,6 +1612,12 @@ class NXMultiReduce(NXReduce):
                     transform_file = os.path.join(self.directory, 
                                                   'transform.nxs')
                     transform_path = 'transform/data'
+                if self.backend == 'native':
+                    input_files = [root[entry][transform_path].nxfilename
+                                   for entry in self.entries]
+                    self.native_combine(task, title, input_files,
+                                        transform_file)
+                    return
                 tic = timeit.default_timer()
                 with Lock(transform_file):
                     if os.path.exists(transform_file):
@@ -1284,6 +1650,28 @@ class NXMultiReduce(NXReduce):
         else:
             self.logger.info('Data already combined')
 
+    def native_combine(self, task, title, input_files, transform_file):
+        """Sum the entry transforms chunk by chunk without using CCTW.
+
+        Each input file is only locked while it is being read. The sum
+        only replaces the transform file when it is complete.
+        """
+        with Lock(input_files[0]), h5.File(input_files[0], 'r') as f:
+            shape = f['entry/data/v'].shape
+        tic = self.start_progress(0, shape[0])
+        with Lock(transform_file):
+            for l in sum_transforms(input_files, transform_file, shape,
+                                    lock=True):
+                if self.stopped:
+                    self.record_fail(task)
+                    return
+                self.update_progress(l)
+        toc = self.stop_progress()
+        self.logger.info('%s (%s) completed (%g seconds)'
+                         % (title, ', '.join(self.entries), toc-tic))
+        with Lock(self.wrapper_file):
+            self.record(task, backend='native', inputs=', '.join(input_files))
+
     def prepare_combine(self):
         if self.mask:
             transform = 'masked_transform'
@@ -1316,6 +1704,8 @@ class NXMultiReduce(NXReduce):
         switches = ['-d %s' %  self.directory, '-e %s' % ' '.join(self.entries)]
         if self.mask:
             switches.append('-m')
+        if self.backend != 'cctw':
+            switches.append('-B %s' % self.backend)
         if self.overwrite:
             switches.append('-o')
         return command+' '.join(switches)
@@ -1330,76 +1720,94 @@ class NXMultiReduce(NXReduce):
             nxdb.queue_task(self.wrapper_file, 'nxcombine', 'entry')
 
 
-class NXpeak(object):
-
-    def __init__(self, np, average, x, y, z, sigx, sigy, covxy, threshold,
-                 pixel_tolerance, frame_tolerance):
-        self.np = np
-        self.average = average
-        self.intensity = np * average
-        self.x = x
-        self.y = y
-        self.z = z
-        self.sigx = sigx
-        self.sigy = sigy
-        self.covxy = covxy
-        self.threshold = threshold
-        self.peaks = [self]
-        self.pixel_tolerance = pixel_tolerance**2
-        self.frame_tolerance = frame_tolerance
-        self.combined = False
-
-    def __str__(self):
-        return "Peak x=%f y=%f z=%f np=%i avg=%f" % (self.x, self.y, self.z, self.np, self.average)
-
-    def __repr__(self):
-        return "Peak x=%f y=%f z=%f np=%i avg=%f" % (self.x, self.y, self.z, self.np, self.average)
-
-    def __lt__(self, other):
-        return self.z < other.z
-
-    def __eq__(self, other):
-        if abs(self.z - other.z) <= self.frame_tolerance:
-            if (self.x - other.x)**2 + (self.y - other.y)**2 <= self.pixel_tolerance:
-                return True
-            else:
-                return False
+def chunk_statistics(v, pool=None, threads=1, block_size=1048576):
+    """Return the per-pixel sums and maxima and the frame sums of a chunk.
+
+    The chunk is reduced in blocks of detector rows of about 'block_size'
+    bytes, so that the three reductions are made while each block is still
+    in cache and the chunk is only streamed from memory once. If a thread
+    pool is given, the rows are split into one band per thread, since NumPy
+    releases the GIL during the reductions. Returning the per-pixel maxima
+    means that the pixel mask only has to be applied to a single frame
+    rather than to the whole chunk.
+    """
+    frames, rows, columns = v.shape
+    vsum = np.empty((rows, columns), dtype=v[:, :0].sum(0).dtype)
+    vmax = np.empty((rows, columns), dtype=v.dtype)
+    step = max(1, block_size // max(1, frames * columns * v.itemsize))
+    def reduce(band):
+        fsum = np.zeros(frames, dtype=np.float64)
+        for r in range(edges[band], edges[band+1], step):
+            block = v[:, r:min(r+step, edges[band+1])]
+            block.sum(0, out=vsum[r:r+block.shape[1]])
+            block.max(0, out=vmax[r:r+block.shape[1]])
+            fsum += block.sum((1,2), dtype=np.float64)
+        return fsum
+    if pool is not None:
+        bands = max(1, min(threads, rows))
+    else:
+        bands = 1
+    edges = np.linspace(0, rows, bands+1).astype(int)
+    if bands > 1:
+        fsum = np.sum(list(pool.map(reduce, range(bands))), axis=0)
+    else:
+        fsum = reduce(0)
+    return vsum, vmax, fsum
+
+
+def sum_block(input_files, path, first, last, chunks, level=4):
+    """Return the compressed chunks of the summed frames first to last-1.
+
+    This is run by each process of a parallel sum over scans. The frames
+    of each input file are added in turn, and the sum is divided into
+    chunks with the given shape, which are compressed with zlib, so that
+    they can be written directly to a dataset using the HDF5 gzip filter.
+    The first frame must be aligned with the chunk boundaries and edge
+    chunks are padded with zeros. A list of tuples containing the offset
+    of each chunk and its compressed bytes is returned.
+    """
+    total = None
+    for input_file in input_files:
+        with h5.File(input_file, 'r') as f:
+            reader = NXReader(f, path, prefetch=0)
+            if total is None:
+                total = np.zeros((last-first,)+reader.shape[1:],
+                                 dtype=reader.dtype)
+            for i, j, v in reader.slabs(first, last):
+                total[i-first:j-first] += v
+    result = []
+    for z in range(first, last, chunks[0]):
+        for y in range(0, total.shape[1], chunks[1]):
+            for x in range(0, total.shape[2], chunks[2]):
+                block = total[z-first:z-first+chunks[0],
+                              y:y+chunks[1], x:x+chunks[2]]
+                if block.shape != tuple(chunks):
+                    padded = np.zeros(chunks, dtype=total.dtype)
+                    padded[tuple(slice(0, n) for n in block.shape)] = block
+                    block = padded
+                result.append(((z, y, x),
+                               zlib.compress(np.ascontiguousarray(block),
+                                             level)))
+    return result
+
+
+def copy_except(source, target, path):
+    """Copy the contents of an HDF5 group, apart from the object at 'path'.
+
+    Groups containing the excluded object are recreated with their
+    attributes, and soft and external links are copied as links.
+    """
+    path = '/' + path.strip('/')
+    for attr, value in source.attrs.items():
+        target.attrs[attr] = value
+    for name in source:
+        link = source.get(name, getlink=True)
+        full_path = source.name.rstrip('/') + '/' + name
+        if not isinstance(link, h5.HardLink):
+            target[name] = link
+        elif full_path == path:
+            continue
+        elif path.startswith(full_path + '/'):
+            copy_except(source[name], target.require_group(name), path)
         else:
-            return False
-
-    def __ne__(self, other):
-        if abs(self.z - other.z) > self.frame_tolerance:
-            if (self.x - other.x)**2 + (self.y - other.y)**2 > self.pixel_tolerance:
-                return True
-            else:
-                return False
-        else:
-            return False
-
-    def combine(self, other):
-        self.peaks.extend(other.peaks)
-        self.combined = True
-        other.combined = False
-
-    def merge(self):
-        np = sum([p.np for p in self.peaks])
-        intensity = sum([p.intensity for p in self.peaks])
-        self.x = sum([p.x * p.intensity for p in self.peaks]) / intensity
-        self.y = sum([p.y * p.intensity for p in self.peaks]) /intensity
-        self.z = sum([p.z * p.intensity for p in self.peaks]) / intensity
-        self.sigx = sum([p.sigx * p.intensity for p in self.peaks]) / intensity
-        self.sigy = sum([p.sigy * p.intensity for p in self.peaks]) / intensity
-        self.covxy = sum([p.covxy * p.intensity for p in self.peaks]) / intensity
-        self.np = np
-        self.intensity = intensity
-        self.average = self.intensity / self.np
-
-    def isvalid(self, mask):
-        if mask is not None:
-            clip = mask[int(self.y),int(self.x)]
-            if clip:
-                return False
-        if np.isclose(self.average, 0.0) or np.isnan(self.average) or self.np < 5:
-            return False
-        else:
-            return True
+            source.copy(name, target)
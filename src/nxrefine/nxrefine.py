@@ -1,5 +1,6 @@
 from __future__ import absolute_import, unicode_literals
 
+import hashlib
 import numpy as np
 import os
 import random
@@ -7,7 +8,10 @@ import six
 
 from nexusformat.nexus import *
 from .unitcell import unitcell
-from . import closest
+try:
+    from . import closest
+except ImportError:
+    closest = None
 
 from numpy.linalg import inv, norm
 
@@ -38,6 +42,19 @@ def rotmat(axis, angle):
     return np.matrix(mat)
 
 
+def drotmat(axis, angle):
+    """Return the derivative of rotmat with respect to the angle."""
+    cang = np.cos(angle*radians) * radians
+    sang = np.sin(angle*radians) * radians
+    if axis == 1:
+        mat = np.array(((0,0,0), (0,-sang,-cang), (0,cang,-sang)))
+    elif axis == 2:
+        mat = np.array(((-sang,0,cang), (0,0,0), (-cang,0,-sang)))
+    else:
+        mat = np.array(((-sang,-cang,0), (cang,-sang,0), (0,0,0)))
+    return np.matrix(mat)
+
+
 def vec(x, y=0.0, z=0.0):
     return np.matrix((x, y, z)).T
 
@@ -46,13 +63,51 @@ def norm_vec(vec):
     return vec / norm(vec)
 
 
+def read_only(value):
+    """Return a read-only copy of an array, or any other value unchanged"""
+    if isinstance(value, np.ndarray):
+        value = value.copy()
+        value.setflags(write=False)
+    return value
+
+
 class NXRefine(object):
 
     symmetries = ['cubic', 'tetragonal', 'orthorhombic', 'hexagonal', 
                   'monoclinic', 'triclinic']
     centrings = ['P', 'A', 'B', 'C', 'I', 'F', 'R']
 
+    lattice_dependencies = ('unitcell', 'Bimat', 'Bmat', 'UBmat', 'UBimat')
+    dependencies = {'a': lattice_dependencies,
+                    'b': lattice_dependencies,
+                    'c': lattice_dependencies,
+                    'alpha': lattice_dependencies,
+                    'beta': lattice_dependencies,
+                    'gamma': lattice_dependencies,
+                    'centring': ('unitcell',),
+                    'Umat': ('UBmat', 'UBimat'),
+                    'standard': ('Oimat', 'geometry_maps'),
+                    'yaw': ('Dmat', 'Dimat', 'geometry_maps'),
+                    'pitch': ('Dmat', 'Dimat', 'geometry_maps'),
+                    'roll': ('Dmat', 'Dimat', 'geometry_maps'),
+                    'distance': ('geometry_maps',),
+                    'xc': ('geometry_maps',),
+                    'yc': ('geometry_maps',),
+                    'pixel_size': ('geometry_maps',),
+                    'wavelength': ('geometry_maps',),
+                    'gonpitch': ('G0imat',),
+                    'omega': ('G0imat',),
+                    'chi': ('G0imat',)}
+
+    jacobian_parameters = ['a', 'b', 'c', 'alpha', 'beta', 'gamma', 'xc', 'yc',
+                           'distance', 'pixel_size', 'yaw', 'pitch', 'roll',
+                           'wavelength', 'phi', 'phi_step', 'gonpitch',
+                           'omega', 'chi'] + ['U%d%d' % (i,j) for i in range(3)
+                                                              for j in range(3)]
+    jacobian_parameters += ['Rx', 'Ry', 'Rz']
+
     def __init__(self, node=None):
+        self._cache = {}
         if node is not None:
             self.entry = node.nxentry
         else:
@@ -107,6 +162,8 @@ class NXRefine(object):
         self.grid_shape = None
         self.grid_step = None
         self.standard = True
+        self.U0 = None
+        self.orientation_rotations = {}
 
         self._idx = None
         
@@ -117,6 +174,34 @@ class NXRefine(object):
         if self.entry:
             self.read_parameters()
 
+    def __setattr__(self, name, value):
+        if name in self.dependencies:
+            value = read_only(value)
+        object.__setattr__(self, name, value)
+        if name in self.dependencies and '_cache' in self.__dict__:
+            self.invalidate(*self.dependencies[name])
+
+    def invalidate(self, *names):
+        """Remove the named matrices from the cache, or all of them.
+
+        Setting any of the parameters in 'dependencies' invalidates the
+        matrices that are calculated from them. Array parameters, such as
+        'Umat', and the cached matrices are stored as read-only copies, so
+        they cannot be modified in place without invalidating the cache.
+        """
+        if names:
+            for name in names:
+                self._cache.pop(name, None)
+        else:
+            self._cache.clear()
+
+    def cached(self, name, function):
+        try:
+            return self._cache[name]
+        except KeyError:
+            self._cache[name] = read_only(function())
+            return self._cache[name]
+
     def read_parameter(self, path, default=None, attr=None):
         try:
             if attr:
@@ -530,10 +615,9 @@ class NXRefine(object):
 
     @property
     def unitcell(self):
-        if (self._unitcell is None or
-            not np.allclose(self._unitcell.lattice_parameters,
-                            np.array(self.lattice_parameters))):
-           self._unitcell = unitcell(self.lattice_parameters, self.centring)
+        self._unitcell = self.cached('unitcell',
+                                     lambda: unitcell(self.lattice_parameters,
+                                                      self.centring))
         self._unitcell.makerings(self.ds_max)
         return self._unitcell
 
@@ -555,15 +639,22 @@ class NXRefine(object):
         calculated from the lattice parameters
         """
         if self.Umat is not None:
-            return self.Umat * self.Bmat
+            return self.cached('UBmat', lambda: self.Umat * self.Bmat)
         else:
             return np.matrix(np.eye(3))
 
+    @property
+    def UBimat(self):
+        return self.cached('UBimat', lambda: inv(self.UBmat))
+
     @property
     def Bimat(self):
         """Create a B matrix containing the column basis vectors of the direct 
         unit cell.
         """
+        return self.cached('Bimat', self.calculate_Bimat)
+
+    def calculate_Bimat(self):
         a, b, c, alpha, beta, gamma = self.lattice_parameters
         alpha = alpha * radians
         beta = beta * radians
@@ -579,7 +670,7 @@ class NXRefine(object):
         """Create a B matrix containing the column basis vectors of the direct 
         unit cell.
         """
-        return inv(self.Bimat)
+        return self.cached('Bmat', lambda: inv(self.Bimat))
 
     @property
     def Omat(self):
@@ -594,6 +685,10 @@ class NXRefine(object):
         else:
             return np.matrix(((0,0,1), (0,1,0), (-1,0,0)))
 
+    @property
+    def Oimat(self):
+        return self.cached('Oimat', lambda: inv(self.Omat))
+
     @property
     def Dmat(self):
         """Define the matrix, whose inverse physically orients the detector.
@@ -601,9 +696,13 @@ class NXRefine(object):
         It also transforms detector coords into lab coords.
         Operation order:    yaw -> pitch -> roll
         """
-        return inv(rotmat(1, self.roll) *
-                   rotmat(2, self.pitch) *
-                   rotmat(3, self.yaw))
+        return self.cached('Dmat', lambda: inv(rotmat(1, self.roll) *
+                                               rotmat(2, self.pitch) *
+                                               rotmat(3, self.yaw)))
+
+    @property
+    def Dimat(self):
+        return self.cached('Dimat', lambda: inv(self.Dmat))
 
     def Gmat(self, phi):
         """Define the matrix that physically orients the goniometer head.
@@ -633,17 +732,70 @@ class NXRefine(object):
     def Evec(self):
         return vec(1.0 / self.wavelength)
 
+    def Gmats(self, phi):
+        """Return a stack of the inverse Gmat matrices for an array of phi.
+
+        Gmat(phi) is the product of a fixed matrix and a rotation about z,
+        so the inverses are calculated from the transposed rotations.
+        """
+        phi = np.asarray(phi, dtype=np.float64) * radians
+        cphi, sphi = np.cos(phi), np.sin(phi)
+        Rimat = np.zeros(phi.shape+(3,3))
+        Rimat[...,0,0] = Rimat[...,1,1] = cphi
+        Rimat[...,0,1] = sphi
+        Rimat[...,1,0] = -sphi
+        Rimat[...,2,2] = 1.0
+        return Rimat @ np.asarray(self.G0imat)
+
+    @property
+    def G0imat(self):
+        """Return the inverse of the phi-independent part of Gmat."""
+        return self.cached('G0imat', lambda: inv(rotmat(2,self.gonpitch) *
+                                                 rotmat(3, self.omega) *
+                                                 rotmat(1, self.chi)))
+
     def Gvec(self, x, y, z):
+        return np.matrix(self.calculate_Gvecs(x, y, z)[0]).T
+
+    def calculate_Gvecs(self, x, y, z):
+        """Return an (N,3) array of G vectors of the specified pixels"""
+        x, y, z = (np.atleast_1d(np.asarray(v, dtype=np.float64))
+                   for v in (x, y, z))
+        x, y, z = np.broadcast_arrays(x, y, z)
         phi = self.phi + self.phi_step * z
-        v1 = vec(x, y)
-        v2 = self.pixel_size * inv(self.Omat) * (v1 - self.Cvec)
-        v3 = inv(self.Dmat) * v2 - self.Dvec
-        return (inv(self.Gmat(phi)) * 
-                ((norm_vec(v3) / self.wavelength) - self.Evec))
+        Cvec = np.asarray(self.Cvec).ravel()
+        v1 = np.array((x - Cvec[0], y - Cvec[1], np.zeros(x.shape) - Cvec[2]))
+        v2 = self.pixel_size * np.asarray(self.Oimat) @ v1
+        v3 = (np.asarray(self.Dimat) @ v2 -
+              np.asarray(self.Dvec).reshape(3,1))
+        v4 = (v3 / norm(v3, axis=0) / self.wavelength -
+              np.asarray(self.Evec).reshape(3,1))
+        return np.einsum('nij,jn->ni', self.Gmats(phi), v4)
+
+    def calculate_hkls(self, x, y, z):
+        """Return an (N,3) array of the hkls of the specified pixels"""
+        if self.Umat is not None:
+            Gvecs = self.calculate_Gvecs(x, y, z)
+            return Gvecs @ np.asarray(self.UBimat).T
+        else:
+            return np.zeros((np.size(x), 3))
+
+    def calculate_diffs(self, hkls):
+        """Return the reciprocal space differences of an (N,3) hkl array"""
+        hkls = np.asarray(hkls)
+        return norm((hkls - np.rint(hkls)) @ np.asarray(self.Bmat).T, axis=1)
+
+    def packed_Gvecs(self, idx):
+        """Return the G vectors of the peaks as a contiguous (N,3) array"""
+        return np.ascontiguousarray(self.calculate_Gvecs(self.xp[idx],
+                                                         self.yp[idx],
+                                                         self.zp[idx]),
+                                    dtype=np.float64)
 
     def get_Gvecs(self, idx):
-        self.Gvecs = [self.Gvec(x,y,z) for x,y,z 
-                      in zip(self.xp[idx], self.yp[idx], self.zp[idx])]
+        self.Gvecs = [np.matrix(G).T for G in
+                      self.calculate_Gvecs(self.xp[idx], self.yp[idx],
+                                           self.zp[idx])]
         return self.Gvecs
 
     def set_polar_max(self, polar_max):
@@ -651,31 +803,84 @@ class NXRefine(object):
             if not isinstance(self.polar_angle, np.ndarray):
                 self.polar_angle, self.azimuthal_angle = \
                     self.calculate_angles(self.xp, self.yp)
-            self.x = []
-            self.y = []
-            for i in range(self.npks):
-                if self.polar_angle[i] <= polar_max:
-                    self.x.append(self.xp[i])
-                    self.y.append(self.yp[i])
+            mask = self.polar_angle <= polar_max
+            self.x = list(self.xp[mask])
+            self.y = list(self.yp[mask])
         except Exception:
             pass
         self.polar_max = polar_max
         self._idx = None
 
     def calculate_angles(self, x, y):
-        """Calculate the polar and azimuthal angles of the specified pixels"""
-        Oimat = inv(self.Omat)
-        Mat = self.pixel_size * inv(self.Dmat) * Oimat
-        polar_angles = []
-        azimuthal_angles = []
-        for i in range(len(x)):
-            peak = Oimat * (vec(x[i], y[i]) - self.Cvec)
-            v = norm(Mat * peak)
-            polar_angle = np.arctan(v / self.distance)
-            polar_angles.append(polar_angle)
-            azimuthal_angles.append(np.arctan2(-peak[1,0], peak[2,0]))
-        return (np.array(polar_angles) * degrees, 
-                np.array(azimuthal_angles) * degrees)
+        """Calculate the polar and azimuthal angles of the specified pixels
+
+        The pixel coordinates are broadcast against each other, so the
+        angles of a whole detector image can be calculated at once.
+        """
+        Oimat = np.asarray(self.Oimat)
+        Mat = self.pixel_size * np.asarray(self.Dimat) @ Oimat
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                   np.asarray(y, dtype=np.float64))
+        Cvec = np.asarray(self.Cvec).ravel()
+        peaks = Oimat @ np.array((np.ravel(x) - Cvec[0], np.ravel(y) - Cvec[1],
+                                  np.zeros(x.size) - Cvec[2]))
+        v = norm(Mat @ peaks, axis=0)
+        polar_angles = np.arctan(v / self.distance).reshape(x.shape)
+        azimuthal_angles = np.arctan2(-peaks[1], peaks[2]).reshape(x.shape)
+        return (polar_angles * degrees, azimuthal_angles * degrees)
+
+    def geometry_hash(self, shape):
+        """Return a hash of the detector shape and geometry"""
+        geometry = (tuple(int(s) for s in shape), bool(self.standard)) + tuple(
+            float(p) for p in (self.distance, self.xc, self.yc, self.yaw,
+                               self.pitch, self.roll, self.pixel_size,
+                               self.wavelength))
+        return hashlib.sha1(repr(geometry).encode('utf-8')).hexdigest()[:16]
+
+    def calculate_geometry_maps(self, shape):
+        """Return a (3, ny, nx) float32 array of pixel two-theta, chi and |Q|"""
+        y, x = np.ogrid[0:shape[0], 0:shape[1]]
+        maps = np.empty((3,)+tuple(shape), dtype=np.float32)
+        maps[0], maps[1] = self.calculate_angles(x, y)
+        maps[2] = 4 * np.pi * np.sin(maps[0] * radians / 2) / self.wavelength
+        return maps
+
+    def geometry_maps(self, shape, directory=None):
+        """Return maps of the two-theta, chi and |Q| values of every detector pixel.
+
+        The maps are returned as a (3, ny, nx) float32 array, which is cached
+        until the shape or one of the detector parameters is changed. If a
+        'directory' is specified, the maps are also saved there in a file
+        whose name contains a hash of the detector geometry, so scans with
+        the same settings share a single file, which is memory-mapped when
+        it is reused. Nothing is written to disk by default.
+        """
+        shape = tuple(int(s) for s in shape)
+        if ('geometry_maps' in self._cache and
+                self._cache['geometry_maps'][0] == shape):
+            return self._cache['geometry_maps'][1]
+        maps = None
+        if directory:
+            filename = os.path.join(directory,
+                                    'geometry_%s.npy' % self.geometry_hash(shape))
+            try:
+                maps = np.load(filename, mmap_mode='r')
+            except (IOError, ValueError):
+                maps = None
+        if maps is None:
+            maps = self.calculate_geometry_maps(shape)
+            if directory:
+                try:
+                    if not os.path.exists(directory):
+                        os.makedirs(directory)
+                    temp_file = filename[:-4] + '_%s.npy' % os.getpid()
+                    np.save(temp_file, maps)
+                    os.replace(temp_file, filename)
+                    maps = np.load(filename, mmap_mode='r')
+                except (IOError, OSError):
+                    pass
+        self._cache['geometry_maps'] = (shape, maps)
+        return maps
 
     def calculate_rings(self, polar_max=None):
         """Calculate the polar angles of the Bragg peak rings"""
@@ -709,10 +914,9 @@ class NXRefine(object):
         """Assign all the peaks to rings (stored in 'rp')"""
         polar_max = self.polar_max
         self.set_polar_max(max(self.polar_angle))
-        rings = self.rings
-        self.rp = np.zeros((self.npks), np.int16)
-        for i in range(self.npks):
-            self.rp[i] = (np.abs(self.polar_angle[i] - rings)).argmin()
+        rings = np.asarray(self.rings)
+        self.rp = np.abs(np.asarray(self.polar_angle)[:,np.newaxis] -
+                         rings).argmin(axis=1).astype(np.int16)
         self.set_polar_max(polar_max)
 
     def compatible(self, i, j):
@@ -727,37 +931,90 @@ class NXRefine(object):
             return True
         else:
             return False
-        
+
+    def ring_angles(self, rings):
+        """Return the sorted angles allowed between each pair of rings.
+
+        The result is a dictionary, keyed by the pairs of ring indices,
+        containing the values returned by 'angle_rings' as sorted arrays.
+        """
+        cell = self.unitcell
+        angles = {}
+        for ring1 in rings:
+            for ring2 in rings:
+                if (ring2, ring1) in angles:
+                    angles[(ring1, ring2)] = angles[(ring2, ring1)]
+                else:
+                    angles[(ring1, ring2)] = np.unique(np.around(
+                        np.arccos(cell.getanglehkls(ring1, ring2)[1])
+                        * degrees, 3))
+        return angles
+
+    def compatibility(self, peaks):
+        """Return a boolean matrix of the compatible pairs of peaks.
+
+        This is equivalent to calling 'compatible' for each pair, but the
+        G vectors and the angles allowed between each pair of rings are
+        only calculated once, and the angles between peaks are matched to
+        the nearest allowed values using searchsorted.
+        """
+        peaks = np.asarray(peaks, dtype=int)
+        Gvecs = self.calculate_Gvecs(self.xp[peaks], self.yp[peaks],
+                                     self.zp[peaks])
+        Gvecs = Gvecs / norm(Gvecs, axis=1)[:,np.newaxis]
+        with np.errstate(invalid='ignore'):
+            angles = np.around(np.arccos(Gvecs @ Gvecs.T) * degrees, 3)
+        rings = np.asarray(self.rp)[peaks]
+        matrix = np.zeros(angles.shape, dtype=bool)
+        ring_list = np.unique(rings)
+        ring_angles = self.ring_angles(ring_list)
+        for ring1 in ring_list:
+            rows = np.where(rings == ring1)[0]
+            for ring2 in ring_list[ring_list >= ring1]:
+                allowed = ring_angles[(ring1, ring2)]
+                if allowed.size == 0:
+                    continue
+                cols = np.where(rings == ring2)[0]
+                block = angles[np.ix_(rows, cols)]
+                k = np.searchsorted(allowed, block)
+                lower = allowed[np.clip(k-1, 0, allowed.size-1)]
+                upper = allowed[np.clip(k, 0, allowed.size-1)]
+                close = ((np.abs(lower - block) < self.peak_tolerance) |
+                         (np.abs(upper - block) < self.peak_tolerance))
+                matrix[np.ix_(rows, cols)] = close
+                matrix[np.ix_(cols, rows)] = close.T
+        np.fill_diagonal(matrix, False)
+        return matrix
+
     def generate_grains(self):
         self.assign_rings()
         grains = []
         peaks = [i for i in range(self.npks) 
                  if self.polar_angle[i] < self.polar_max]
-        assigned = set()
-        for (i, j) in [(i, j) for i in peaks for j in peaks if j > i]:
-            if self.compatible(i,j):
-                if i not in assigned and j not in assigned:
-                    grains.append([i,j])
-                    assigned.add(i)
-                    assigned.add(j)
-                else:
-                    for grain in grains:
-                        if i not in grain:
-                            bad = [k for k in grain if not self.compatible(i,k)]
-                            if not bad:
-                                grain.append(i)
-                                assigned.add(i)
-                        if j not in grain:
-                            bad = [k for k in grain if not self.compatible(j,k)]
-                            if not bad:
-                                grain.append(j)
-                                assigned.add(j)
-        self.grains = sorted([NXgrain(grain) 
+        matrix = self.compatibility(peaks)
+        # Each row is True for the peaks compatible with all the grain's peaks
+        allowed = np.zeros((len(peaks)//2+1, len(peaks)), dtype=bool)
+        assigned = np.zeros(len(peaks), dtype=bool)
+        for (i, j) in zip(*np.nonzero(np.triu(matrix))):
+            if not assigned[i] and not assigned[j]:
+                allowed[len(grains)] = matrix[i] & matrix[j]
+                grains.append([i,j])
+                assigned[i] = assigned[j] = True
+            else:
+                for k in (i, j):
+                    added = np.nonzero(allowed[:len(grains), k])[0]
+                    for g in added:
+                        grains[g].append(k)
+                    allowed[added] &= matrix[k]
+                    if added.size > 0:
+                        assigned[k] = True
+        self.grains = sorted([NXgrain([peaks[i] for i in grain])
                               for grain in grains if len(grain) > 2])
         for grain in self.grains:
             self.orient(grain)
-            grain.peaks = [i for i in range(self.npks) 
-                           if self.diff(i) < self.hkl_tolerance]
+            diffs = self.calculate_diffs(self.calculate_hkls(self.xp, self.yp,
+                                                             self.zp))
+            grain.peaks = list(np.where(diffs < self.hkl_tolerance)[0])
             grain.score = self.score(grain)            
         
     def orient(self, grain=None):
@@ -791,24 +1048,16 @@ class NXRefine(object):
 
     def get_hkl(self, x, y, z):
         """Determine hkl for the specified pixel coordinates"""
-        if self.Umat is not None:
-            v5 = self.Gvec(x, y, z)
-#            v6 = inv(self.Umat) * v5
-#            v7 = inv(self.Bmat) * v6
-            v7 = inv(self.UBmat) * v5
-            return list(np.array(v7.T)[0])
-        else:
-            return [0.0, 0.0, 0.0]
+        return list(self.calculate_hkls(x, y, z)[0])
 
     def get_hkls(self):
         """Determine the set of hkls for all the peaks as three columns"""
-        return zip(*[self.hkl(i) for i in range(self.npks)])
+        return zip(*self.hkls)
 
     @property
     def hkls(self):
         """Determine the set of hkls for all the peaks"""
-        return [self.get_hkl(self.xp[i], self.yp[i], self.zp[i]) 
-                for i in range(self.npks)]
+        return self.calculate_hkls(self.xp, self.yp, self.zp).tolist()
 
     def hkl(self, i):
         """Return the calculated (hkl) for the specified peak"""
@@ -816,11 +1065,7 @@ class NXRefine(object):
 
     def polar(self, i):
         """Return the polar angle for the specified peak"""
-        Oimat = inv(self.Omat)
-        Mat = self.pixel_size * inv(self.Dmat) * Oimat
-        peak = Oimat * (vec(self.xp[i], self.yp[i]) - self.Cvec)
-        v = norm(Mat * peak)
-        return np.arctan(v / self.distance)
+        return float(self.calculate_angles(self.xp[i], self.yp[i])[0]) * radians
     def score(self, grain=None):
         self.set_idx()
         if self.idx:
@@ -839,8 +1084,11 @@ class NXRefine(object):
     def set_idx(self, hkl_tolerance=None):
         if hkl_tolerance is None:
             hkl_tolerance = self.hkl_tolerance
-        _idx = list(np.where(self.polar_angle < self.polar_max)[0])
-        self._idx = [i for i in _idx if self.diff(i) < hkl_tolerance]
+        _idx = np.where(self.polar_angle < self.polar_max)[0]
+        diffs = self.calculate_diffs(self.calculate_hkls(self.xp[_idx],
+                                                         self.yp[_idx],
+                                                         self.zp[_idx]))
+        self._idx = list(_idx[diffs < hkl_tolerance])
 
     @property
     def weights(self):
@@ -848,19 +1096,25 @@ class NXRefine(object):
 
     def diffs(self):
         """Return the set of reciproal space differences for all the peaks"""
-        return np.array([self.diff(i) for i in self.idx])
+        idx = self.idx
+        return self.calculate_diffs(self.calculate_hkls(self.xp[idx],
+                                                        self.yp[idx],
+                                                        self.zp[idx]))
 
     def diff(self, i):
         """Determine the reciprocal space difference between the calculated 
         (hkl) and the closest integer (hkl) of the specified peak"""
-        h, k, l = self.hkl(i)
-        Q = np.matrix((h, k, l)).T
-        Q0 = np.matrix((np.rint(h), np.rint(k), np.rint(l))).T
-        return norm(self.Bmat * (Q - Q0))
+        return self.calculate_diffs([self.hkl(i)])[0]
 
     def angle_diffs(self):
         """Return the set of reciproal space differences for all the peaks"""
-        return np.array([self.angle_diff(i) for i in self.idx])
+        idx = self.idx
+        hkls = np.rint(self.calculate_hkls(self.xp[idx], self.yp[idx],
+                                           self.zp[idx]))
+        ds = np.sqrt(np.einsum('ni,ij,nj->n', hkls, self.unitcell.gi, hkls))
+        polar0 = 2 * np.arcsin(ds * self.wavelength / 2)
+        polar = self.calculate_angles(self.xp[idx], self.yp[idx])[0] * radians
+        return np.abs(polar - polar0)
 
     def angle_diff(self, i):
         """Determine the reciprocal space difference between the calculated 
@@ -888,7 +1142,7 @@ class NXRefine(object):
             h = np.array(h)[peaks]
             k = np.array(k)[peaks]
             l = np.array(l)[peaks]
-            diffs = np.array([self.diff(i) for i in peaks])
+            diffs = self.calculate_diffs(np.array((h, k, l)).T)
         else:
             h = k = l = diffs = np.zeros(peaks.shape, dtype=np.float32)
         return list(zip(peaks, x, y, z, polar, azi, intensity, h, k, l, diffs))
@@ -958,23 +1212,152 @@ class NXRefine(object):
             self.parameters.add('beta', self.beta, vary=lattice)
             self.parameters.add('gamma', self.gamma, vary=lattice)
 
+    def lattice_derivatives(self):
+        """Return the derivatives of Bimat with respect to the lattice
+        parameters, including those tied to them by the symmetry.
+        """
+        a, b, c, alpha, beta, gamma = self.lattice_parameters
+        alpha = alpha * radians
+        beta = beta * radians
+        gamma = gamma * radians
+        Bimat = np.asarray(self.Bimat)
+        B23, B33 = Bimat[1,2], Bimat[2,2]
+        d = dict((p, np.zeros((3,3)))
+                 for p in ('a', 'b', 'c', 'alpha', 'beta', 'gamma'))
+        d['a'][0,0] = 1.0
+        d['b'][0,1], d['b'][1,1] = np.cos(gamma), np.sin(gamma)
+        d['c'][:,2] = Bimat[:,2] / c
+        dB23 = -c * np.sin(alpha) / np.sin(gamma) * radians
+        d['alpha'][1,2], d['alpha'][2,2] = dB23, -B23 * dB23 / B33
+        dB23 = c * np.sin(beta) * np.cos(gamma) / np.sin(gamma) * radians
+        d['beta'][0,2] = -c * np.sin(beta) * radians
+        d['beta'][1,2] = dB23
+        d['beta'][2,2] = ((c**2 * np.cos(beta) * np.sin(beta) * radians -
+                           B23 * dB23) / B33)
+        dB23 = (c * (np.cos(beta) - np.cos(alpha) * np.cos(gamma)) /
+                np.sin(gamma)**2 * radians)
+        d['gamma'][0,1] = -b * np.sin(gamma) * radians
+        d['gamma'][1,1] = b * np.cos(gamma) * radians
+        d['gamma'][1,2], d['gamma'][2,2] = dB23, -B23 * dB23 / B33
+        if self.symmetry == 'cubic':
+            d['a'] = d['a'] + d['b'] + d['c']
+        elif self.symmetry == 'tetragonal' or self.symmetry == 'hexagonal':
+            d['a'] = d['a'] + d['b']
+        return d
+
+    def jacobian(self, names):
+        """Return the derivatives of the reciprocal space differences.
+
+        The array has a row for each peak in idx and a column for each of
+        the named parameters, which can include the orientation matrix
+        elements, 'U00' to 'U22', or its rotations, 'Rx', 'Ry' and 'Rz'.
+        The nearest integer (hkl) values are held fixed, so this is the
+        Jacobian of the residuals used in refine_hkls and
+        refine_orientation_matrix.
+        """
+        idx = self.idx
+        x, y, z = (np.asarray(v, dtype=np.float64)[idx]
+                   for v in (self.xp, self.yp, self.zp))
+        Oimat, Dimat = np.asarray(self.Oimat), np.asarray(self.Dimat)
+        Uimat, Bmat = np.asarray(inv(self.Umat)), np.asarray(self.Bmat)
+        Cvec = np.asarray(self.Cvec).ravel()
+        v1 = np.array((x - Cvec[0], y - Cvec[1], np.zeros(x.shape) - Cvec[2]))
+        v2 = self.pixel_size * Oimat @ v1
+        v3 = Dimat @ v2 - np.asarray(self.Dvec).reshape(3,1)
+        r3 = norm(v3, axis=0)
+        n3 = v3 / r3
+        k = n3 / self.wavelength - np.asarray(self.Evec).reshape(3,1)
+        Gimats = self.Gmats(self.phi + self.phi_step * z)
+        G = np.einsum('nij,jn->in', Gimats, k)
+        UiG = Uimat @ G
+        hkls = np.rint(np.asarray(self.Bimat) @ UiG)
+        d = UiG - Bmat @ hkls
+        r = norm(d, axis=0)
+        r[r == 0.0] = np.inf
+
+        def dv3_to_dd(dv3):
+            dk = (dv3 - n3 * np.sum(n3 * dv3, axis=0)) / r3 / self.wavelength
+            return Uimat @ np.einsum('nij,jn->in', Gimats, dk)
+
+        def dG0_to_dd(dG0):
+            dk = -dG0 @ np.asarray(self.G0imat) @ k
+            return Uimat @ np.einsum('nij,jn->in', Gimats, dk)
+
+        def product(rotations, name):
+            mat = np.eye(3)
+            for p, axis, angle in rotations:
+                if p == name:
+                    mat = mat @ np.asarray(drotmat(axis, angle))
+                else:
+                    mat = mat @ np.asarray(rotmat(axis, angle))
+            return mat
+
+        Kz = np.array(((0,-1,0), (1,0,0), (0,0,0))) * radians
+        rotations = (('roll', 1, self.roll), ('pitch', 2, self.pitch),
+                     ('yaw', 3, self.yaw))
+        goniometer = (('gonpitch', 2, self.gonpitch),
+                      ('omega', 3, self.omega), ('chi', 1, self.chi))
+        orientation = tuple((p, axis, self.orientation_rotations.get(p, 0.0))
+                            for p, axis in (('Rx', 1), ('Ry', 2), ('Rz', 3)))
+        if set(names).intersection(('a', 'b', 'c', 'alpha', 'beta', 'gamma')):
+            dBimats = self.lattice_derivatives()
+        jac = np.zeros((len(idx), len(names)))
+        for i, name in enumerate(names):
+            if name in ('a', 'b', 'c', 'alpha', 'beta', 'gamma'):
+                dd = Bmat @ dBimats[name] @ Bmat @ hkls
+            elif name in ('Rx', 'Ry', 'Rz'):
+                dU = product(orientation, name) @ np.asarray(self.U0)
+                dd = -Uimat @ dU @ UiG
+            elif name.startswith('U'):
+                row, col = int(name[1]), int(name[2])
+                dd = -np.outer(Uimat[:,row], UiG[col])
+            elif name == 'xc':
+                dd = dv3_to_dd(-self.pixel_size * Dimat @ Oimat[:,0:1])
+            elif name == 'yc':
+                dd = dv3_to_dd(-self.pixel_size * Dimat @ Oimat[:,1:2])
+            elif name == 'distance':
+                dd = dv3_to_dd(np.array(((1.0,), (0.0,), (0.0,))))
+            elif name == 'pixel_size':
+                dd = dv3_to_dd(Dimat @ Oimat @ v1)
+            elif name in ('roll', 'pitch', 'yaw'):
+                dd = dv3_to_dd(product(rotations, name) @ v2)
+            elif name == 'wavelength':
+                dd = -UiG / self.wavelength
+            elif name == 'phi':
+                dd = -Uimat @ Kz @ G
+            elif name == 'phi_step':
+                dd = -Uimat @ Kz @ G * z
+            elif name in ('gonpitch', 'omega', 'chi'):
+                dd = dG0_to_dd(product(goniometer, name))
+            else:
+                raise NeXusError("No analytic derivative for '%s'" % name)
+            jac[:,i] = np.sum(d * dd, axis=0) / r
+        return jac
+
+    def has_jacobian(self, parameters):
+        return all(p in self.jacobian_parameters for p in parameters
+                   if parameters[p].vary)
+
     def get_parameters(self, parameters):
         for p in parameters:
-            vars(self)[p] = parameters[p].value
+            setattr(self, p, parameters[p].value)
         self.set_symmetry()
         
     def restore_parameters(self):
         for p in self.parameters:
-            vars(self)[p] = self.parameters[p].init_value
+            setattr(self, p, self.parameters[p].init_value)
         self.set_symmetry()
 
-    def refine_hkls(self, method='leastsq', **opts):
+    def refine_hkls(self, method='leastsq', jacobian=False, **opts):
         self.set_idx()
         from lmfit import minimize, fit_report
         if self.Umat is None:
             raise NeXusError('No orientation matrix defined')
         p0 = self.define_parameters(**opts)
-        self.result = minimize(self.hkl_residuals, p0, method=method)
+        kwds = {}
+        if jacobian and method == 'leastsq' and self.has_jacobian(p0):
+            kwds['Dfun'] = self.hkl_jacobian
+        self.result = minimize(self.hkl_residuals, p0, method=method, **kwds)
         self.fit_report = fit_report(self.result)
         if self.result.success:
             self.get_parameters(self.result.params)
@@ -983,6 +1366,10 @@ class NXRefine(object):
         self.get_parameters(parameters)
         return self.diffs()
 
+    def hkl_jacobian(self, parameters):
+        self.get_parameters(parameters)
+        return self.jacobian([p for p in parameters if parameters[p].vary])
+
     def refine_angles(self, method='nelder', **opts):
         self.set_idx()
         from lmfit import minimize, fit_report
@@ -1006,18 +1393,75 @@ class NXRefine(object):
         return p
 
     def get_orientation_matrix(self, p):
-        for i in range(3):
-            for j in range(3):
-                self.Umat[i,j] = p['U%d%d' % (i,j)].value
+        self.Umat = np.matrix([[p['U%d%d' % (i,j)].value for j in range(3)]
+                               for i in range(3)])
+
+    def define_orientation_rotations(self):
+        """Parametrize the orientation matrix by three rotation angles.
+
+        The rotations are applied to the orthogonal matrix closest to the
+        current orientation matrix, so the refined matrix remains unitary.
+        """
+        from lmfit import Parameters
+        W, _, Vt = np.linalg.svd(np.asarray(self.Umat))
+        self.U0 = np.matrix(W @ Vt)
+        p = Parameters()
+        for name in ('Rx', 'Ry', 'Rz'):
+            p.add(name, 0.0)
+        self.init_p = self.Umat
+        return p
 
-    def refine_orientation_matrix(self, **opts):
+    def get_orientation_rotations(self, p):
+        self.orientation_rotations = dict((name, p[name].value)
+                                          for name in ('Rx', 'Ry', 'Rz'))
+        self.Umat = (rotmat(1, p['Rx'].value) * rotmat(2, p['Ry'].value) *
+                     rotmat(3, p['Rz'].value) * self.U0)
+
+    def refine_UBimat(self, tolerance=None, cycles=10):
+        """Refine the orientation matrix with the closest extension.
+
+        The inverse UB matrix is fitted to the peaks in idx by the linear
+        least-squares refinement of closest.score_and_refine, which is
+        repeated until the number of peaks indexed within the tolerance,
+        in units of (hkl), is unchanged. The number is returned.
+        """
+        if closest is None:
+            raise NeXusError('The closest extension is not available')
+        if tolerance is None:
+            tolerance = self.hkl_tolerance * norm(self.Bimat, 2)
+        Gvecs = self.packed_Gvecs(self.idx)
+        UBimat = np.array(self.UBimat, dtype=np.float64)
+        npks = 0
+        for i in range(cycles):
+            n = closest.score_and_refine(UBimat, Gvecs, tolerance)[0]
+            if n == npks:
+                break
+            npks = n
+        if npks > 2:
+            self.Umat = np.matrix(inv(UBimat)) * self.Bimat
+        return npks
+
+    def refine_orientation_matrix(self, jacobian=False, rotations=False,
+                                  linear=False, **opts):
         self.set_idx()
         from lmfit import minimize, fit_report
-        p0 = self.define_orientation_matrix()
-        self.result = minimize(self.orient_residuals, p0, **opts)
+        if linear and closest is not None:
+            self.refine_UBimat()
+        if rotations:
+            p0 = self.define_orientation_rotations()
+            residuals, Dfun = self.rotation_residuals, self.rotation_jacobian
+        else:
+            p0 = self.define_orientation_matrix()
+            residuals, Dfun = self.orient_residuals, self.orient_jacobian
+        if jacobian and opts.get('method', 'leastsq') == 'leastsq':
+            opts['Dfun'] = Dfun
+        self.result = minimize(residuals, p0, **opts)
         self.fit_report = fit_report(self.result)
         if self.result.success:
-            self.get_orientation_matrix(self.result.params)
+            if rotations:
+                self.get_orientation_rotations(self.result.params)
+            else:
+                self.get_orientation_matrix(self.result.params)
 
     def restore_orientation_matrix(self):
         self.Umat = self.init_p
@@ -1026,6 +1470,18 @@ class NXRefine(object):
         self.get_orientation_matrix(p)
         return self.diffs()
 
+    def orient_jacobian(self, p):
+        self.get_orientation_matrix(p)
+        return self.jacobian([n for n in p if p[n].vary])
+
+    def rotation_residuals(self, p):
+        self.get_orientation_rotations(p)
+        return self.diffs()
+
+    def rotation_jacobian(self, p):
+        self.get_orientation_rotations(p)
+        return self.jacobian([n for n in p if p[n].vary])
+
 
 class NXpeak(object):
 
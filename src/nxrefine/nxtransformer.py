@@ -0,0 +1,498 @@
+import copy
+import os
+from contextlib import contextmanager
+
+import h5py as h5
+import numpy as np
+from numpy.linalg import inv
+
+from nexusformat.nexus import *
+
+from .nxlock import Lock
+from .nxreader import NXReader
+from .nxrefine import rotmat
+
+
+class NXTransformer(object):
+    """Transform detector frames into a regular (h, k, l) grid.
+
+    This is an in-process alternative to the external CCTW transform. It
+    uses the instrument geometry and orientation matrix of an NXRefine
+    instance, together with the grid defined by 'NXRefine.define_grid',
+    to map every detector pixel of every frame into reciprocal space. Each
+    pixel is oversampled in x, y and z, and the intensity of each sample
+    is added to the nearest grid point. The accumulated intensities and
+    weights are stored in 'v' and 'n' arrays, with shape (l, k, h), which
+    are written to '/entry/data' of the output file in the same layout as
+    CCTW.
+
+    Only numerical values are copied from the NXRefine instance, so that
+    the transformer can be passed to other processes.
+
+    Parameters
+    ----------
+    refine : NXRefine
+        Refinement instance containing the geometry and HKL grid.
+    pixel_mask : array_like, optional
+        2D array of pixels to be excluded from the transform.
+    data_mask : array_like, optional
+        3D array of pixels to be excluded, e.g., around Bragg peaks.
+    weights : array_like, optional
+        Weight of each frame, e.g., the normalized monitor counts.
+    oversample : tuple of int, optional
+        Number of samples per pixel in x, y, and z (frames).
+    """
+
+    def __init__(self, refine, pixel_mask=None, data_mask=None,
+                 weights=None, oversample=(1, 1, 4)):
+        self.pixel_size = refine.pixel_size
+        self.wavelength = refine.wavelength
+        self.phi = refine.phi
+        self.phi_step = refine.phi_step
+        self.Mat = np.asarray(refine.pixel_size * inv(refine.Dmat) *
+                              inv(refine.Omat))
+        self.Cvec = np.asarray(refine.Cvec).ravel()
+        self.Dvec = np.asarray(refine.Dvec).ravel()
+        self.Evec = np.asarray(refine.Evec).ravel()
+        self.UBimat = np.asarray(inv(refine.UBmat))
+        self.Gmat = np.asarray(refine.Gmat(0.0))
+        self.origin = np.array((refine.h_start, refine.k_start,
+                                refine.l_start), dtype=np.float64)
+        self.step = np.array((refine.h_step, refine.k_step, refine.l_step),
+                             dtype=np.float64)
+        self.shape = (int(refine.l_shape), int(refine.k_shape),
+                      int(refine.h_shape))
+        self.grid_shape = self.shape
+        self.l_offset = 0
+        self.pixel_mask = pixel_mask
+        self.data_mask = data_mask
+        self.weights = weights
+        self.oversample = tuple(int(o) for o in oversample)
+        self.v = None
+        self.n = None
+        self.Q = None
+
+    def initialize(self):
+        """Allocate the 'v' and 'n' arrays"""
+        self.v = np.zeros(self.shape, dtype=np.float32)
+        self.n = np.zeros(self.shape, dtype=np.float32)
+
+    def pixel_vectors(self, shape):
+        """Return the lab scattering vector of each detector sample.
+
+        A list is returned containing one (3, ny*nx) array for each of the
+        x and y oversampling positions. The lab vectors are independent of
+        the frame, so they are only calculated once.
+        """
+        ny, nx = shape
+        ox, oy = self.oversample[:2]
+        vectors = []
+        for sy in range(oy):
+            for sx in range(ox):
+                x = np.arange(nx) + (sx + 0.5) / ox - 0.5
+                y = np.arange(ny) + (sy + 0.5) / oy - 0.5
+                x, y = np.meshgrid(x, y)
+                p = np.array((x.ravel() - self.Cvec[0],
+                              y.ravel() - self.Cvec[1],
+                              np.zeros(x.size) - self.Cvec[2]))
+                v3 = self.Mat @ p - self.Dvec[:,np.newaxis]
+                v3 /= np.linalg.norm(v3, axis=0)
+                vectors.append(v3 / self.wavelength - self.Evec[:,np.newaxis])
+        return vectors
+
+    def frame_matrices(self, z):
+        """Return the matrices converting lab vectors to HKL for frame z"""
+        oz = self.oversample[2]
+        matrices = []
+        for sz in range(oz):
+            phi = self.phi + self.phi_step * (z + (sz + 0.5) / oz - 0.5)
+            Gmat = self.Gmat @ np.asarray(rotmat(3, phi))
+            matrices.append(self.UBimat @ inv(Gmat))
+        return matrices
+
+    def grid_indices(self, M, Q):
+        """Return the flattened grid indices of the samples within the grid.
+
+        The lab vectors, Q, are converted to HKL by the matrix, M. The l
+        indices are calculated first, so that the h and k indices are only
+        calculated for samples within the l range of the grid. The indices
+        of the valid samples within Q are also returned.
+        """
+        nl, nk, nh = self.shape
+        l = (np.rint((M[2] @ Q - self.origin[2]) / self.step[2]).astype(
+             np.int64) - self.l_offset)
+        rows = np.flatnonzero((l >= 0) & (l < nl))
+        l = l[rows]
+        hk = np.rint((M[:2] @ Q[:,rows] - self.origin[:2,np.newaxis]) /
+                     self.step[:2,np.newaxis]).astype(np.int64)
+        valid = (hk[0] >= 0) & (hk[0] < nh) & (hk[1] >= 0) & (hk[1] < nk)
+        flat = (l[valid] * nk + hk[1][valid]) * nh + hk[0][valid]
+        return flat, rows[valid]
+
+    def slab(self, first, last):
+        """Return a copy of the transformer restricted to l = first to last-1.
+
+        The copy only allocates and accumulates its own slab of the grid.
+        The offset of the slab is stored in the shard files written by the
+        copy, so the slabs of a parallel transform can be assembled by
+        'sum_transforms'.
+        """
+        transformer = copy.copy(self)
+        transformer.l_offset = self.l_offset + first
+        transformer.shape = (last - first,) + self.shape[1:]
+        transformer.v = transformer.n = None
+        return transformer
+
+    def transform_frame(self, frame, z, mask=None):
+        """Add a single frame, whose frame number is z, to the grid.
+
+        Parameters
+        ----------
+        frame : ndarray
+            2D array of detector counts.
+        z : int
+            Frame number used to determine the goniometer angle.
+        mask : ndarray, optional
+            2D array of pixels to be excluded from this frame.
+        """
+        if self.Q is None:
+            self.Q = self.pixel_vectors(frame.shape)
+        if self.v is None:
+            self.initialize()
+        counts = frame.ravel().astype(np.float64)
+        keep = np.ones(counts.size, dtype=bool)
+        if self.pixel_mask is not None:
+            keep &= np.logical_not(np.ravel(self.pixel_mask).astype(bool))
+        if mask is not None:
+            keep &= np.logical_not(np.ravel(mask).astype(bool))
+        if self.weights is not None:
+            weight = float(self.weights[z])
+        else:
+            weight = 1.0
+        nsamples = np.prod(self.oversample)
+        counts = counts[keep] / nsamples
+        weight = weight / nsamples
+        indices, values = [], []
+        matrices = self.frame_matrices(z)
+        for Q in self.Q:
+            Q = Q[:,keep]
+            for M in matrices:
+                flat, rows = self.grid_indices(M, Q)
+                indices.append(flat)
+                values.append(counts[rows])
+        self.accumulate(np.concatenate(indices), np.concatenate(values),
+                        weight)
+
+    def accumulate(self, flat, values, weight):
+        """Add values to the grid points with the given flattened indices.
+
+        If the indices span a range that is small compared to the number of
+        values, the values are summed over that range with 'np.bincount'.
+        Otherwise, they are added in place with 'np.add.at', so that neither
+        the indices nor the whole grid have to be sorted or traversed.
+        """
+        if flat.size == 0:
+            return
+        v = self.v.reshape(-1)
+        n = self.n.reshape(-1)
+        lo, hi = flat.min(), flat.max() + 1
+        if hi - lo <= 4 * flat.size:
+            flat = flat - lo
+            v[lo:hi] += np.bincount(flat, weights=values,
+                                    minlength=hi-lo).astype(np.float32)
+            n[lo:hi] += (weight * np.bincount(flat, minlength=hi-lo)
+                         ).astype(np.float32)
+        else:
+            np.add.at(v, flat, values.astype(np.float32))
+            np.add.at(n, flat, np.float32(weight))
+
+    def transform_frames(self, reader, first=0, last=None):
+        """Transform frames first to last-1, yielding before each slab.
+
+        Parameters
+        ----------
+        reader : NXReader
+            Reader of the 3D array of detector frames, which are read in
+            chunk-aligned slabs.
+        first, last : int, optional
+            Range of frames to be transformed.
+        """
+        if last is None:
+            last = reader.shape[0]
+        for i, j, v in reader.slabs(first, last):
+            yield i
+            if self.data_mask is not None:
+                m = self.data_mask[i:j,:,:]
+            for k in range(j-i):
+                if self.data_mask is not None:
+                    self.transform_frame(v[k], i+k, mask=m[k])
+                else:
+                    self.transform_frame(v[k], i+k)
+
+    def bounds(self):
+        """Return the (l, k, h) slices containing all the nonzero weights"""
+        if self.n is None:
+            return None
+        nlk = self.n.any(axis=2)
+        nh = self.n.any(axis=(0,1))
+        slices = []
+        for nonzero in (nlk.any(axis=1), nlk.any(axis=0), nh):
+            idx = np.flatnonzero(nonzero)
+            if idx.size == 0:
+                return None
+            slices.append(slice(idx[0], idx[-1]+1))
+        return tuple(slices)
+
+    def write(self, filename, shard=False):
+        """Save the 'v' and 'n' arrays to '/entry/data' of a NeXus file.
+
+        If 'shard' is True, only the region containing nonzero weights is
+        saved, with its offset within the full grid stored as an attribute.
+        Shards are summed into a complete transform using 'sum_transforms'.
+        """
+        if shard:
+            bounds = self.bounds()
+            if bounds is None:
+                bounds = (slice(0, 1),) * 3
+            v, n = self.v[bounds], self.n[bounds]
+            offset = [s.start for s in bounds]
+            offset[0] += self.l_offset
+        else:
+            v, n = self.v, self.n
+        root = NXroot(NXentry())
+        root['entry/data'] = NXdata(NXfield(v, name='v'))
+        root['entry/data/n'] = NXfield(n, name='n')
+        if shard:
+            root['entry/data'].attrs['offset'] = offset
+            root['entry/data'].attrs['shape'] = self.grid_shape
+        root.save(filename, 'w')
+
+
+def transform_block(transformer, data_file, path, first, last, shard_file,
+                    mask_file=None):
+    """Transform a block of frames into a shard file.
+
+    This is run by each process of a parallel transform, usually with a
+    transformer restricted to a slab of the grid by 'NXTransformer.slab'.
+    The data, and the 3D mask if there is one, are opened read-only within
+    the process.
+    """
+    mask = None
+    with h5.File(data_file, 'r') as f:
+        if mask_file:
+            transformer.data_mask = read_peak_mask(mask_file)
+            if transformer.data_mask is None:
+                mask = h5.File(mask_file, 'r')
+                transformer.data_mask = mask['entry/mask']
+        for i in transformer.transform_frames(NXReader(f, path), first, last):
+            pass
+        if mask:
+            mask.close()
+    transformer.data_mask = None
+    transformer.write(shard_file, shard=True)
+    return shard_file
+
+
+class NXPeakMask(object):
+    """Sparse 3D mask of the discs surrounding each Bragg peak.
+
+    The mask is defined by the center, radius and frame range of each disc,
+    so its size scales with the number of peaks rather than the volume of
+    the data. Dense blocks of frames are only created when the mask is
+    sliced along the first axis, e.g., 'mask[i:j,:,:]', using the same
+    indexing as the dense mask written by earlier versions.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the 3D data, i.e., (frames, y, x).
+    x, y : array_like
+        Pixel coordinates of the disc centers.
+    z_start, z_stop : array_like
+        Range of frames, z_start to z_stop-1, masked by each disc.
+    radius : array_like or float
+        Radius of each disc in pixels.
+    """
+
+    def __init__(self, shape, x, y, z_start, z_stop, radius):
+        self.shape = tuple(int(i) for i in shape)
+        self.x = np.asarray(x, dtype=np.int32)
+        self.y = np.asarray(y, dtype=np.int32)
+        self.z_start = np.asarray(z_start, dtype=np.int32)
+        self.z_stop = np.asarray(z_stop, dtype=np.int32)
+        self.radius = np.broadcast_to(np.asarray(radius, dtype=np.float32),
+                                      self.x.shape)
+        self._discs = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, tuple):
+            idx = (idx,)
+        if isinstance(idx[0], slice):
+            first, last, step = idx[0].indices(self.shape[0])
+            block = self.frames(first, last)[::step]
+            if len(idx) > 1:
+                block = block[(slice(None),)+idx[1:]]
+        else:
+            frame = int(idx[0])
+            if frame < 0:
+                frame += self.shape[0]
+            block = self.frames(frame, frame+1)[0]
+            if len(idx) > 1:
+                block = block[idx[1:]]
+        return block
+
+    def disc(self, radius):
+        """Return a boolean image of a disc centered in the array"""
+        if radius not in self._discs:
+            r = int(np.ceil(radius))
+            d = np.arange(-r, r+1)
+            self._discs[radius] = (d[np.newaxis,:]**2 +
+                                   d[:,np.newaxis]**2 < radius**2)
+        return self._discs[radius]
+
+    def frames(self, first, last):
+        """Return a dense boolean mask of frames first to last-1"""
+        nz, ny, nx = self.shape
+        first, last = max(first, 0), min(last, nz)
+        block = np.zeros((max(last-first, 0), ny, nx), dtype=bool)
+        for k in np.flatnonzero((self.z_start < last) &
+                                (self.z_stop > first)):
+            disc = self.disc(float(self.radius[k]))
+            r = disc.shape[0] // 2
+            x0, x1 = self.x[k] - r, self.x[k] + r + 1
+            y0, y1 = self.y[k] - r, self.y[k] + r + 1
+            if x1 <= 0 or y1 <= 0 or x0 >= nx or y0 >= ny:
+                continue
+            z0 = max(self.z_start[k], first) - first
+            z1 = min(self.z_stop[k], last) - first
+            region = block[z0:z1, max(y0,0):min(y1,ny), max(x0,0):min(x1,nx)]
+            region |= disc[max(y0,0)-y0:min(y1,ny)-y0,
+                           max(x0,0)-x0:min(x1,nx)-x0]
+        return block
+
+    def write_frames(self, field, chunk_size):
+        """Write the dense mask to a 3D field, one block of frames at a time.
+
+        Only blocks containing masked pixels are written, so the field
+        should be created with a fill value of False. This is a generator
+        that yields the first frame of each block before it is written.
+        """
+        for i in range(0, self.shape[0], chunk_size):
+            yield i
+            block = self.frames(i, i+chunk_size)
+            if block.any():
+                field[i:i+block.shape[0]] = block
+
+    def save(self, entry):
+        """Save the mask parameters to the 'peak_mask' group of an entry"""
+        if 'peak_mask' in entry:
+            del entry['peak_mask']
+        entry['peak_mask'] = NXcollection(x=self.x, y=self.y,
+                                          z_start=self.z_start,
+                                          z_stop=self.z_stop,
+                                          radius=np.array(self.radius))
+        entry['peak_mask'].attrs['shape'] = self.shape
+
+
+def peak_mask(shape, x, y, z, radius, width):
+    """Return a sparse mask of discs around peaks at (x, y, z).
+
+    Each disc is masked over 'width' frames centered on int(z), with the
+    same pixel and frame ranges as the original dense 3D mask.
+    """
+    half_width = float(width) / 2.0
+    i, j = int(half_width-0.5), int(half_width+0.5)
+    z = np.asarray(z).astype(np.int32)
+    return NXPeakMask(shape, np.asarray(x).astype(np.int32),
+                      np.asarray(y).astype(np.int32),
+                      np.maximum(z-i, 0), z+j, radius)
+
+
+def read_peak_mask(filename):
+    """Return the sparse mask stored in a mask file, or None"""
+    with h5.File(filename, 'r') as f:
+        if 'entry/peak_mask' not in f:
+            return None
+        group = f['entry/peak_mask']
+        return NXPeakMask(group.attrs['shape'], group['x'][()],
+                          group['y'][()], group['z_start'][()],
+                          group['z_stop'][()], group['radius'][()])
+
+
+def create_transform(filename, shape, chunks=(32, 32, 32)):
+    """Create an empty transform file with chunked 'v' and 'n' arrays"""
+    chunks = tuple(min(c, s) for (c, s) in zip(chunks, shape))
+    root = NXroot(NXentry())
+    root['entry/data'] = NXdata(NXfield(shape=shape, dtype=np.float32,
+                                        name='v', chunks=chunks,
+                                        fillvalue=0.0))
+    root['entry/data/n'] = NXfield(shape=shape, dtype=np.float32,
+                                   chunks=chunks, fillvalue=0.0)
+    root.save(filename, 'w')
+    return root
+
+
+def sum_transforms(input_files, output_file, shape, chunks=(32, 32, 32),
+                   lock=False):
+    """Sum the 'v' and 'n' arrays of transform files into a new file.
+
+    The output grid is processed in slabs that are aligned with the HDF5
+    chunks along the first (l) axis, so that memory use is bounded by the
+    slab size. The inputs may be complete transforms or shards, whose
+    offset within the grid is stored in the 'offset' attribute. If 'lock'
+    is True, each input file is only locked while it is being read.
+
+    The sum is written to a temporary file, which replaces the output file
+    once every slab has been summed, so that a stopped or failed sum leaves
+    no partial output. This is a generator that yields the first index of
+    each slab before it is summed.
+    """
+    temp_file = output_file + '.tmp'
+    inputs = []
+    for input_file in input_files:
+        with input_lock(input_file, lock), h5.File(input_file, 'r') as f:
+            data = f['entry/data']
+            if 'offset' in data.attrs:
+                offset = tuple(int(o) for o in data.attrs['offset'])
+            else:
+                offset = (0, 0, 0)
+            inputs.append((input_file, offset, data['v'].shape))
+    try:
+        root = create_transform(temp_file, shape, chunks)
+        v_out, n_out = root['entry/data/v'], root['entry/data/n']
+        slab = v_out.chunks[0]
+        for l in range(0, shape[0], slab):
+            yield l
+            l_stop = min(l+slab, shape[0])
+            v = np.zeros((l_stop-l,)+tuple(shape[1:]), dtype=np.float32)
+            n = np.zeros((l_stop-l,)+tuple(shape[1:]), dtype=np.float32)
+            for input_file, (l0, k0, h0), input_shape in inputs:
+                i0, i1 = max(l, l0), min(l_stop, l0+input_shape[0])
+                if i1 <= i0:
+                    continue
+                region = (slice(i0-l, i1-l),
+                          slice(k0, k0+input_shape[1]),
+                          slice(h0, h0+input_shape[2]))
+                with input_lock(input_file, lock), \
+                     h5.File(input_file, 'r') as f:
+                    v[region] += f['entry/data/v'][i0-l0:i1-l0]
+                    n[region] += f['entry/data/n'][i0-l0:i1-l0]
+            v_out[l:l_stop] = v
+            n_out[l:l_stop] = n
+        os.replace(temp_file, output_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+@contextmanager
+def input_lock(filename, lock=True):
+    """Lock a file within a 'with' block, if 'lock' is True"""
+    if lock:
+        with Lock(filename):
+            yield
+    else:
+        yield
@@ -72,6 +72,12 @@ class RefineLatticeDialog(BaseDialog):
         
         self.orientation_button = self.action_buttons(
             ('Refine Orientation Matrix', self.refine_orientation))
+        self.linear_box = QtWidgets.QCheckBox('Linear Pre-refinement')
+        self.linear_box.setCheckState(QtCore.Qt.Unchecked)
+        self.linear_box.setToolTip(
+            'Refine the orientation matrix with the closest extension first')
+        self.orientation_button.insertWidget(
+            self.orientation_button.count()-1, self.linear_box)
 
         self.lattice_buttons = self.action_buttons(
                                    ('Plot', self.plot_lattice),
@@ -385,7 +391,8 @@ class RefineLatticeDialog(BaseDialog):
         self.parameters.status_message.repaint()
         self.mainwindow.app.app.processEvents()
         self.transfer_parameters()
-        self.refine.refine_orientation_matrix()
+        self.refine.refine_orientation_matrix(
+            linear=self.linear_box.isChecked())
         self.parameters.result = self.refine.result
         self.parameters.fit_report = self.refine.fit_report
         self.fit_report.append(self.refine.fit_report)
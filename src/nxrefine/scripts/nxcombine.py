@@ -19,6 +19,9 @@ def main():
         nargs='+', help='names of entries to be searched')
     parser.add_argument('-m', '--mask', action='store_true', 
                         help='combine transforms with 3D mask')
+    parser.add_argument('-B', '--backend', default='cctw',
+                        choices=['cctw', 'native'],
+                        help='program used to combine transforms')
     parser.add_argument('-o', '--overwrite', action='store_true', 
                         help='overwrite existing transform')
     parser.add_argument('-q', '--queue', action='store_true',
@@ -27,7 +30,7 @@ def main():
     args = parser.parse_args()
     
     reduce = NXMultiReduce(args.directory, entries=args.entries, mask=args.mask,
-                           overwrite=args.overwrite)
+                           backend=args.backend, overwrite=args.overwrite)
     if args.queue:
         reduce.queue()
     else:
@@ -14,6 +14,12 @@ def main():
                         help='peak threshold - defaults to maximum counts/10')
     parser.add_argument('-f', '--first', type=int, help='first frame')
     parser.add_argument('-l', '--last', type=int, help='last frame')
+    parser.add_argument('-s', '--search3d', action='store_true',
+                        help='connect peaks in 3D while searching')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes used to search for peaks')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of slabs to read ahead in the background')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite existing peaks')
     parser.add_argument('-p', '--parent', default=None,
@@ -27,6 +33,8 @@ def main():
         reduce = NXReduce(entry, args.directory, find=True,
                           threshold=args.threshold,
                           first=args.first, last=args.last,
+                          search3d=args.search3d, workers=args.workers,
+                          prefetch=args.prefetch,
                           overwrite=args.overwrite)
         if args.queue:
             reduce.queue()
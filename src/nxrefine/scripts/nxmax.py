@@ -20,6 +20,8 @@ def main():
         nargs='+', help='names of entries to be processed')
     parser.add_argument('-f', '--first', type=int, help='first frame')
     parser.add_argument('-l', '--last', type=int, help='last frame')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of slabs to read ahead in the background')
     parser.add_argument('-o', '--overwrite', action='store_true', 
                         help='overwrite existing maximum')
     parser.add_argument('-q', '--queue', action='store_true',
@@ -30,7 +32,7 @@ def main():
     for entry in args.entries:
         reduce = NXReduce(entry, args.directory, maxcount=True,
                           first=args.first, last=args.last, 
-                          overwrite=args.overwrite)
+                          prefetch=args.prefetch, overwrite=args.overwrite)
         if args.queue:
             reduce.queue()
         else:
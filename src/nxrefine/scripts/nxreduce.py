@@ -24,14 +24,30 @@ def main():
                         help='find maximum counts')
     parser.add_argument('-f', '--find', action='store_true',
                         help='find peaks')
+    parser.add_argument('-s', '--search3d', action='store_true',
+                        help='connect peaks in 3D while searching')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes used to find peaks and '
+                             'perform native transforms')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of slabs to read ahead in the background')
+    parser.add_argument('-F', '--fused', action='store_true',
+                        help='find maximum counts and peaks in one pass')
     parser.add_argument('-c', '--copy', action='store_true',
                         help='copy parameters')
     parser.add_argument('-r', '--refine', action='store_true',
                         help='refine lattice parameters')
+    parser.add_argument('-J', '--jacobian', action='store_true',
+                        help='use analytic derivatives in the refinement')
+    parser.add_argument('-L', '--linear', action='store_true',
+                        help='refine the orientation matrix linearly first')
     parser.add_argument('-t', '--transform', action='store_true',
                         help='perform CCTW transforms')
     parser.add_argument('-M', '--mask', action='store_true',
                         help='perform CCTW transforms with 3D mask')
+    parser.add_argument('-B', '--backend', default='cctw',
+                        choices=['cctw', 'native'],
+                        help='program used to perform transforms')
     parser.add_argument('-b', '--combine', action='store_true',
                         help='combine CCTW transforms')
     parser.add_argument('-o', '--overwrite', action='store_true', 
@@ -43,16 +59,23 @@ def main():
 
     for entry in args.entries:
         reduce = NXReduce(entry, args.directory, link=args.link,
-                          maxcount=args.max, find=args.find, copy=args.copy,
-                          refine=args.refine, transform=args.transform,
-                          mask=args.mask, overwrite=args.overwrite)
+                          maxcount=args.max, find=args.find,
+                          search3d=args.search3d, workers=args.workers,
+                          prefetch=args.prefetch,
+                          fused=args.fused, copy=args.copy,
+                          refine=args.refine, jacobian=args.jacobian,
+                          linear=args.linear,
+                          transform=args.transform,
+                          mask=args.mask, backend=args.backend,
+                          overwrite=args.overwrite)
         if args.queue:
             reduce.queue()
         else:
             reduce.nxreduce()
     if args.combine:
         reduce = NXMultiReduce(args.directory, entries=args.entries,
-                                     mask=args.mask, overwrite=args.overwrite)
+                                     mask=args.mask, backend=args.backend,
+                                     overwrite=args.overwrite)
         if args.queue:
             reduce.queue()
         else:
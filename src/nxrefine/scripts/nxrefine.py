@@ -12,6 +12,10 @@ def main():
         nargs='+', help='names of entries to be processed')
     parser.add_argument('-l', '--lattice', action='store_true',
                         help='refine lattice parameters')
+    parser.add_argument('-J', '--jacobian', action='store_true',
+                        help='use analytic derivatives in the refinement')
+    parser.add_argument('-L', '--linear', action='store_true',
+                        help='refine the orientation matrix linearly first')
     parser.add_argument('-o', '--overwrite', action='store_true', 
                         help='overwrite existing maximum')
     parser.add_argument('-q', '--queue', action='store_true',
@@ -25,7 +29,9 @@ def main():
         else:
             lattice = False
         reduce = NXReduce(entry, args.directory, refine=True,
-                          lattice=lattice, overwrite=args.overwrite)
+                          lattice=lattice, jacobian=args.jacobian,
+                          linear=args.linear,
+                          overwrite=args.overwrite)
         if args.queue:
             reduce.queue()
         else:
@@ -14,11 +14,14 @@ def main():
                         help='list of scan directories to be summed')
     parser.add_argument('-o', '--overwrite', action='store_true',
                         help='overwrite existing peaks')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes used to sum the scans')
 
     args = parser.parse_args()
     
     for entry in args.entries:
-        reduce = NXReduce(entry, args.directory, overwrite=args.overwrite)
+        reduce = NXReduce(entry, args.directory, overwrite=args.overwrite,
+                          workers=args.workers)
         reduce.nxsum(args.scans)
 
 
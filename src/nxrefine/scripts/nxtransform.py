@@ -25,6 +25,11 @@ def main():
                         help='radius of mask around each peak (in pixels)')
     parser.add_argument('-w', '--width', default=3, 
                         help='width of masked region (in frames)')
+    parser.add_argument('-B', '--backend', default='cctw',
+                        choices=['cctw', 'native'],
+                        help='program used to perform transforms')
+    parser.add_argument('-n', '--workers', type=int, default=1,
+                        help='number of processes used by the native backend')
     parser.add_argument('-o', '--overwrite', action='store_true', 
                         help='overwrite existing transforms')
     parser.add_argument('-q', '--queue', action='store_true',
@@ -36,6 +41,7 @@ def main():
         reduce = NXReduce(entry, args.directory, transform=True, mask=args.mask,
                           Qh=args.qh, Qk=args.qk, Ql=args.ql,
                           radius=args.radius, width=args.width,
+                          backend=args.backend, workers=args.workers,
                           overwrite=args.overwrite)
         if args.mask:
             if args.queue:
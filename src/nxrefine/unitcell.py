@@ -32,6 +32,8 @@ import math
 
 import logging
 
+from collections import OrderedDict
+
 def radians(x):
     return x*math.pi/180.
 
@@ -86,7 +88,7 @@ def I(h,k,l):
     return (h+k+l)%2 != 0
 
 def F(h,k,l):
-    return (h+k)%2!=0 or (h+l)%2!=0 or (k+l)%2!=0
+    return ((h+k)%2!=0) | ((h+l)%2!=0) | ((k+l)%2!=0)
 
 def R(h,k,l):
     return (-h+k+l)%3 != 0
@@ -101,6 +103,37 @@ outif = {
     "F" : F ,
     "R" : R}
 
+# Reflection lists shared between unit cells, keyed by the lattice parameters,
+# the symmetry and dsmax, with the most recently used last
+hkl_cache = OrderedDict()
+hkl_cachesize = 32
+
+def ringstarts(ds, tol):
+    """
+    Return the indices of the first reflection in each powder ring
+
+    A reflection belongs to the current ring if its ds differs from that
+    of the first reflection in the ring by less than tol. Gaps of at least
+    tol between consecutive reflections always start a new ring, so only
+    clusters wider than the tolerance need to be split one ring at a time.
+    """
+    if len(ds) == 0:
+        return numpy.zeros(0, dtype=numpy.intp)
+    bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(ds) >= tol)+1,
+                                [len(ds)]))
+    starts = bounds[:-1]
+    wide = ds[bounds[1:]-1] - ds[starts] >= tol
+    if not wide.any():
+        return starts
+    split = [starts[~wide]]
+    for start, stop in zip(starts[wide], bounds[1:][wide]):
+        i = start
+        while i < stop:
+            split.append([i])
+            j = i + numpy.searchsorted(ds[i:stop], ds[i]+tol, side='left')
+            i = max(j, i+1)
+    return numpy.sort(numpy.concatenate(split)).astype(numpy.intp)
+
 def cellfromstring(s):
     items = s.split()
     # print items
@@ -176,12 +209,16 @@ class unitcell:
             print(numpy.dot(numpy.transpose(self.B),
                                self.B)-self.gi) # this should be zero
         self.hkls = None
-        self.peaks = None
+        self._peaks = None
+        self.dsarray = None
+        self.hklarray = None
         self.limit = 0
+        self.ringlimit = None
+        self._ringhkls = None
 
         # used for caching
-        self.anglehkl_rings = None
-        self.anglehkl_cache = None
+        self.anglehkl_cache = OrderedDict()
+        self.anglehkl_cachesize = 1024
         self.ringtol = 0.001
 
     def tostring(self):
@@ -197,68 +234,99 @@ class unitcell:
               self.symmetry)
 
 
+    @property
+    def peaks(self):
+        """
+        List of [ds, (h,k,l)] for the current limit
+
+        The list is only created from the arrays of ds and hkl values
+        when it is requested
+        """
+        if self._peaks is None and self.dsarray is not None:
+            self._peaks = [ [ds, (h,k,l)] for ds, (h,k,l) in
+                            zip(self.dsarray.tolist(),
+                                self.hklarray.tolist()) ]
+        return self._peaks
+
+    @peaks.setter
+    def peaks(self, value):
+        self._peaks = value
+        if value is None or len(value) == 0:
+            self.dsarray = self.hklarray = None
+        else:
+            self.dsarray = numpy.array([peak[0] for peak in value])
+            self.hklarray = numpy.array([peak[1] for peak in value])
+
     def gethkls(self,dsmax):
         """
         Generate hkl list
         Argument dsmax is the d* limit (eg 1/d)
-        Default of zero gives only the (000) reflection
+        Default of zero gives no reflections
+
+        Each index is bounded by dsmax times the corresponding real space
+        cell length and assumes [h|k|l] < 200
+        """
+        self.gethklarrays(dsmax)
+        return self.peaks
+
+    def gethklarrays(self,dsmax):
+        """
+        Return the sorted arrays of ds and hkl values with ds < dsmax
 
-        assumes [h|k|l] < 200
+        The arrays are shared with other unit cells with the same
+        parameters through a bounded cache. If the limit increases, only
+        the shell beyond the previous limit is generated.
+        """
+        if dsmax == self.limit and self.dsarray is not None:
+            return self.dsarray, self.hklarray
+        key = (tuple(self.lattice_parameters), self.symmetry, dsmax)
+        if key in hkl_cache:
+            hkl_cache.move_to_end(key)
+            ds, hkl = hkl_cache[key]
+        else:
+            if self.dsarray is None:
+                ds, hkl = self.generatehkls(dsmax)
+            elif dsmax > self.limit:
+                shell_ds, shell_hkl = self.generatehkls(dsmax, self.limit)
+                ds = numpy.concatenate((self.dsarray, shell_ds))
+                hkl = numpy.concatenate((self.hklarray, shell_hkl))
+            else:
+                keep = self.dsarray < dsmax
+                ds, hkl = self.dsarray[keep], self.hklarray[keep]
+            hkl_cache[key] = (ds, hkl)
+            if len(hkl_cache) > hkl_cachesize:
+                hkl_cache.popitem(last=False)
+        if ds is not self.dsarray:
+            self._peaks = None
+        self.dsarray, self.hklarray = ds, hkl
+        self.limit = dsmax
+        return ds, hkl
+
+    def generatehkls(self,dsmax,dsmin=0.0):
         """
-        if dsmax == self.limit and self.peaks!=None:
-            return self.peaks
-        h=k=0
-        l=1 # skip 0,0,0
-        hs=ks=ls=1
-        b=0
-        peaks=[]
-        while abs(h)<200: # H
-            while abs(k)<200: # K
-                while abs(l)<200: #L
-                    ds=self.ds([h,k,l])
-                    if ds < dsmax:
-                        if not self.absent(h,k,l):
-                            peaks.append([ds,(h,k,l)])
-                        else:
-                            pass
-                        b=0
-                    else:
-                        if ls==1:
-                            ls=-1
-                            l=0
-                        else:
-                            ls=1
-                            l=0
-                            b=b+1
-                            break
-                    l=l+ls
-                k=k+ks
-                # l is always zero here
-                if b>1:
-                    if ks==1:
-                        ks=-1
-                        k=-1
-                    else:
-                        ks=1
-                        k=0
-                        b=b+1
-                        break
-            h=h+hs
-            if b>3:
-                if hs==1:
-                    hs=-1
-                    h=-1
-                else:
-                    hs=1
-                    h=0
-                    break
-
-        peaks.sort()
-        #for peak in peaks:
-        #   print peak
-        self.peaks=peaks
-        self.limit=dsmax
-        return peaks
+        Generate the sorted arrays of ds and hkl with dsmin <= ds < dsmax
+        """
+        hmax, kmax, lmax = [ min(int(math.floor(dsmax*math.sqrt(self.g[i,i]))),
+                                 199) for i in range(3) ]
+        k, l = numpy.meshgrid(numpy.arange(-kmax, kmax+1),
+                              numpy.arange(-lmax, lmax+1), indexing='ij')
+        k, l = k.ravel(), l.ravel()
+        hkls = []
+        dss = []
+        for h in range(-hmax, hmax+1):
+            hkl = numpy.array((numpy.full(k.shape, h), k, l))
+            ds = numpy.sqrt(numpy.einsum('in,in->n', hkl,
+                                         numpy.dot(self.gi, hkl)))
+            keep = ((ds < dsmax) & (ds >= dsmin) & (ds > 0) &
+                    ~numpy.broadcast_to(self.absent(*hkl), ds.shape))
+            hkls.append(hkl[:,keep])
+            dss.append(ds[keep])
+        hkls = numpy.concatenate(hkls, axis=1)
+        dss = numpy.concatenate(dss)
+        # Equivalent reflections are sorted by hkl whatever the rounding
+        order = numpy.lexsort((hkls[2], hkls[1], hkls[0],
+                               numpy.around(dss, 10)))
+        return dss[order], numpy.ascontiguousarray(hkls[:,order].T)
 
     def ds(self,h):
         """ computes 1/d for this hkl = hgh """
@@ -270,22 +338,41 @@ class unitcell:
         Makes a list of computed powder rings
         The tolerance is the difference in d* to decide
         if two peaks overlap
+
+        Each ring contains the reflections whose ds is within the tolerance
+        of the first reflection in the ring. The rings are only recomputed
+        if the limit or tolerance change.
         """
-        self.peaks=self.gethkls(limit+tol) # [ ds, [hkl] ]
-        self.ringds=[]   # a list of floats
-        self.ringhkls={} # a dict of lists of integer hkl
-        # Append first peak
-        peak = self.peaks[0]
-        self.ringds.append(peak[0])
-        self.ringhkls[peak[0]] = [peak[1]]
-        for peak in self.peaks[1:]:
-            if abs(peak[0] - self.ringds[-1]) < tol:
-                self.ringhkls[self.ringds[-1]].append(peak[1])
-            else:
-                self.ringds.append(peak[0])
-                self.ringhkls[self.ringds[-1]]= [peak[1]]
+        if self.ringlimit == (limit, tol):
+            return
+        ds, hkl = self.gethklarrays(limit+tol)
+        starts = ringstarts(ds, tol)
+        self.ringstarts = starts
+        self.ringstops = numpy.append(starts[1:], len(ds))
+        self.ringhklarray = hkl
+        self.ringds = ds[starts].tolist()
+        self._ringhkls = None
+        self.ringlimit = (limit, tol)
         self.ringtol = tol
 
+    @property
+    def ringhkls(self):
+        """
+        Dictionary of the lists of (h,k,l) in each ring, keyed by ring ds
+        """
+        if self._ringhkls is None and self.ringlimit is not None:
+            hkls = [ tuple(h) for h in self.ringhklarray.tolist() ]
+            self._ringhkls = { ds: hkls[start:stop] for ds, start, stop in
+                               zip(self.ringds, self.ringstarts.tolist(),
+                                   self.ringstops.tolist()) }
+        return self._ringhkls
+
+    def ringhklarrays(self,ring):
+        """
+        Return the array of hkls in a ring
+        """
+        return self.ringhklarray[self.ringstarts[ring]:self.ringstops[ring]]
+
     def anglehkls(self,h1,h2):
         """
         Compute the angle between reciprocal lattice vectors h1, h2
@@ -307,23 +394,32 @@ class unitcell:
 
     def getanglehkls(self, ring1, ring2):
         """
-        Cache the last pair called for
+        Return the pairs of hkls in two rings and the cosines of the angles
+        between them
+
+        The most recently used pairs are kept in a bounded cache
         """
-        if self.anglehkl_rings == (ring1, ring2, self.ringtol):
-            return self.anglehkl_cache
-        else:
-            self.anglehkl_rings = (ring1, ring2, self.ringtol)
-            cache = []
-            hcach = []
-            for ha in self.ringhkls[self.ringds[ring1]]:
-                for hb in self.ringhkls[self.ringds[ring2]]:
-                    if ha == hb:
-                        continue
-                    hcach.append( ( ha, hb) )
-                    # Note - returns angle, cosangle
-                    cache.append( self.anglehkls(ha,hb)[1] )
-            self.anglehkl_cache = [ hcach , numpy.array(cache) ]
-            return self.anglehkl_cache
+        key = (ring1, ring2, self.ringtol, self.limit,
+               tuple(self.lattice_parameters))
+        if key in self.anglehkl_cache:
+            self.anglehkl_cache.move_to_end(key)
+            return self.anglehkl_cache[key]
+        ia, ib = self.ringhklarrays(ring1), self.ringhklarrays(ring2)
+        ha, hb = ia.astype(numpy.float64), ib.astype(numpy.float64)
+        ga = numpy.einsum('ni,ij,nj->n', ha, self.gi, ha)
+        gb = numpy.einsum('ni,ij,nj->n', hb, self.gi, hb)
+        costheta = (numpy.dot(ha, numpy.dot(self.gi, hb.T)) /
+                    numpy.sqrt(numpy.outer(ga, gb)))
+        # Exclude identical hkls, as in the original double loop
+        i, j = numpy.nonzero(numpy.any(ha[:,None,:] != hb[None,:,:], axis=2))
+        la = self.ringhkls[self.ringds[ring1]]
+        lb = self.ringhkls[self.ringds[ring2]]
+        hcach = [ (la[a], lb[b]) for a, b in zip(i.tolist(), j.tolist()) ]
+        cache = numpy.clip(costheta[i, j], -1.0, 1.0)
+        self.anglehkl_cache[key] = [ hcach , cache ]
+        if len(self.anglehkl_cache) > self.anglehkl_cachesize:
+            self.anglehkl_cache.popitem(last=False)
+        return self.anglehkl_cache[key]
 
 
     def orient(self,ring1,g1,ring2,g2,verbose=0):
@@ -0,0 +1,56 @@
+import os
+
+import h5py as h5
+import numpy as np
+import pytest
+from nexusformat.nexus import NXdata, NXentry, NXfield, NXlink, NXroot
+
+
+def peak_volume(seed, shape=(48, 64, 80), npeaks=25):
+    """Return a volume of Gaussian peaks on a noisy background"""
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[0:shape[0], 0:shape[1], 0:shape[2]]
+    volume = rng.poisson(2.0, shape).astype(np.float64)
+    for _ in range(npeaks):
+        z0, y0, x0 = [rng.uniform(2, s-2) for s in shape]
+        sz, sy, sx = rng.uniform(1.0, 3.0), rng.uniform(1, 2), rng.uniform(1, 2)
+        volume += rng.uniform(200, 2000) * np.exp(-0.5*(((z-z0)/sz)**2 +
+                                                       ((y-y0)/sy)**2 +
+                                                       ((x-x0)/sx)**2))
+    return volume.astype(np.int32)
+
+
+@pytest.fixture
+def peak_data():
+    return peak_volume(0)
+
+
+@pytest.fixture
+def make_scan(tmp_path):
+    """Return a function that creates a scan with the given raw data.
+
+    The scan follows the directory layout used by NXReduce, i.e.,
+    'sample/label/sample_scan.nxs' contains the entry 'f1', whose data
+    are linked to 'sample/label/scan/f1.h5'. The function returns the
+    scan directory.
+    """
+    label = tmp_path / 'sample' / 'label'
+    os.makedirs(tmp_path / 'tasks', exist_ok=True)
+    def scan(name, data, chunks=None, compression=None):
+        directory = label / name
+        os.makedirs(directory)
+        with h5.File(directory / 'f1.h5', 'w') as f:
+            f.create_dataset('entry/data/data', data=data, chunks=chunks,
+                             compression=compression)
+            f['entry/monitor'] = np.arange(data.shape[0])
+            f['entry/data/monitor'] = h5.SoftLink('/entry/monitor')
+        axes = [NXfield(np.arange(n, dtype=np.float64), name=axis)
+                for n, axis in zip(data.shape,
+                                   ['frame_number', 'y_pixel', 'x_pixel'])]
+        root = NXroot(NXentry(name='entry'))
+        root['f1'] = NXentry(NXdata(NXlink('/entry/data/data',
+                                           file='%s/f1.h5' % name,
+                                           name='data'), axes))
+        root.save(str(label / ('sample_%s.nxs' % name)))
+        return str(directory)
+    return scan
@@ -0,0 +1,69 @@
+"""Compare the fused maximum and peak search with separate nxmax and nxfind."""
+import numpy as np
+import pytest
+from nexusformat.nexus import NXreflections
+
+from nxrefine.nxreader import NXReader
+from nxrefine.nxreduce import NXReduce
+
+
+def peak_array(peaks):
+    return np.array([(p.np, p.intensity, p.x, p.y, p.z, p.sigx, p.sigy,
+                      p.covxy) for p in peaks])
+
+
+def separate(directory, threshold=None, search3d=False):
+    reduce = NXReduce('f1', directory, threshold=threshold, search3d=search3d)
+    maximum = reduce.find_maximum()
+    if threshold is None:
+        reduce.threshold = maximum / 10
+    return maximum, reduce.summed_data, reduce.find_peaks()
+
+
+@pytest.mark.parametrize('search3d', [False, True])
+def test_replay(make_scan, peak_data, search3d):
+    directory = make_scan('scan', peak_data, chunks=(4, 64, 80))
+    reduce = NXReduce('f1', directory, search3d=search3d)
+    maximum, peaks = reduce.find_maximum_and_peaks()
+    expected_maximum, summed_data, expected = separate(directory,
+                                                       search3d=search3d)
+    assert maximum == expected_maximum == peak_data.max()
+    assert reduce.threshold == maximum / 10
+    assert np.array_equal(reduce.summed_data.nxvalue, summed_data.nxvalue)
+    assert len(peaks) == len(expected) > 0
+    assert np.array_equal(peak_array(peaks), peak_array(expected))
+
+
+def test_saved_threshold(make_scan, peak_data):
+    directory = make_scan('scan', peak_data, chunks=(4, 64, 80))
+    reduce = NXReduce('f1', directory)
+    reduce.entry['peaks'] = NXreflections()
+    reduce.entry['peaks'].attrs['threshold'] = 500
+    maximum, peaks = reduce.find_maximum_and_peaks()
+    expected = separate(directory, threshold=500)[2]
+    assert reduce.threshold == 500
+    assert np.array_equal(peak_array(peaks), peak_array(expected))
+
+
+def test_no_peaks(make_scan, peak_data):
+    directory = make_scan('scan', peak_data, chunks=(4, 64, 80))
+    reduce = NXReduce('f1', directory, threshold=1e6, maxcount=True,
+                      find=True)
+    reduce.nxmax_and_find()
+    assert 'nxmax' in reduce.entry and 'nxfind' in reduce.entry
+    assert 'peaks' not in reduce.entry
+
+
+@pytest.mark.parametrize('prefetch', [1, 3])
+def test_prefetch(make_scan, peak_data, prefetch, monkeypatch):
+    directory = make_scan('scan', peak_data, chunks=(4, 64, 80))
+    monkeypatch.setattr(NXReader, 'slab_bytes', peak_data[:8].nbytes)
+    reduce = NXReduce('f1', directory, prefetch=prefetch)
+    assert reduce.reader().prefetch == prefetch
+    assert reduce.reader().slab_frames == 8
+    maximum, summed_data, expected = separate(directory)
+    assert reduce.find_maximum() == maximum
+    assert np.array_equal(reduce.summed_data.nxvalue, summed_data.nxvalue)
+    reduce.threshold = maximum / 10
+    assert np.array_equal(peak_array(reduce.find_peaks()),
+                          peak_array(expected))
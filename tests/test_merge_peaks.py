@@ -0,0 +1,96 @@
+"""Compare the grid-hashed peak merge with the original pairwise merge."""
+import numpy as np
+import pytest
+
+from nxrefine.nxpeaks import NXpeak, merge_peaks
+
+
+def reference_merge(table, threshold, pixel_tolerance, frame_tolerance,
+                    z_min, z_max):
+    """Merge blobs using the nested loops of the original 'find_peaks'"""
+    allpeaks = sorted([NXpeak(*row, threshold, pixel_tolerance,
+                              frame_tolerance) for row in table])
+    merged_peaks = []
+    for z in range(z_min, z_max+1):
+        frame = [peak for peak in allpeaks if peak.z == z]
+        if not merged_peaks:
+            merged_peaks.extend(frame)
+        else:
+            for peak1 in frame:
+                combined = False
+                for peak2 in last_frame:
+                    if peak1 == peak2:
+                        for idx in range(len(merged_peaks)):
+                            if peak1 == merged_peaks[idx]:
+                                break
+                        peak1.combine(merged_peaks[idx])
+                        merged_peaks[idx] = peak1
+                        combined = True
+                        break
+                if not combined:
+                    reversed_peaks = [p for p in reversed(merged_peaks)
+                                      if p.z >= peak1.z - frame_tolerance]
+                    for peak2 in reversed_peaks:
+                        if peak1 == peak2:
+                            for idx in range(len(merged_peaks)):
+                                if peak1 == merged_peaks[idx]:
+                                    break
+                            peak1.combine(merged_peaks[idx])
+                            merged_peaks[idx] = peak1
+                            combined = True
+                            break
+                    if not combined:
+                        merged_peaks.append(peak1)
+        if frame:
+            last_frame = frame
+    merged_peaks = sorted(merged_peaks)
+    for peak in merged_peaks:
+        peak.merge()
+    return sorted(merged_peaks)
+
+
+def blob_table(seed, npeaks=60, nnoise=40, shape=(400, 500), nframes=100):
+    """Return a table of 2D blobs from random 3D peaks and isolated blobs"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(npeaks):
+        x, y = rng.uniform(0, shape[1]), rng.uniform(0, shape[0])
+        z = rng.integers(0, nframes-10)
+        for dz in range(rng.integers(1, 10)):
+            rows.append((rng.integers(5, 200), rng.uniform(10, 1000),
+                         x + rng.normal(0, 2), y + rng.normal(0, 2), z + dz,
+                         rng.uniform(1, 5), rng.uniform(1, 5),
+                         rng.uniform(-1, 1)))
+    for _ in range(nnoise):
+        rows.append((rng.integers(5, 200), rng.uniform(10, 1000),
+                     rng.uniform(0, shape[1]), rng.uniform(0, shape[0]),
+                     rng.integers(0, nframes), rng.uniform(1, 5),
+                     rng.uniform(1, 5), rng.uniform(-1, 1)))
+    table = np.array(rows, dtype=np.float64)
+    return table[rng.permutation(len(table))]
+
+
+def peak_array(peaks):
+    return np.array([(p.np, p.intensity, p.average, p.x, p.y, p.z,
+                      p.sigx, p.sigy, p.covxy) for p in peaks])
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('pixel_tolerance, frame_tolerance',
+                         [(50, 10), (20, 3), (5, 1)])
+def test_merge_peaks(seed, pixel_tolerance, frame_tolerance):
+    table = blob_table(seed)
+    peaks = merge_peaks(table, 100.0, pixel_tolerance, frame_tolerance,
+                        0, 100)
+    expected = reference_merge(table, 100.0, pixel_tolerance,
+                               frame_tolerance, 0, 100)
+    assert len(peaks) == len(expected)
+    assert np.allclose(peak_array(peaks), peak_array(expected), rtol=1e-10)
+
+
+def test_merge_peaks_frame_range():
+    table = blob_table(0)
+    peaks = merge_peaks(table, 100.0, 50, 10, 20, 60)
+    in_range = (table[:,4] >= 20) & (table[:,4] <= 60)
+    expected = reference_merge(table[in_range], 100.0, 50, 10, 20, 60)
+    assert np.allclose(peak_array(peaks), peak_array(expected), rtol=1e-10)
@@ -0,0 +1,67 @@
+"""Test the chunk-aligned slab reads of NXReader."""
+import h5py as h5
+import numpy as np
+import pytest
+
+from nxrefine.nxreader import NXReader, next_prime
+
+
+@pytest.fixture
+def data_file(tmp_path, peak_data):
+    filename = str(tmp_path / 'frames.h5')
+    with h5.File(filename, 'w') as f:
+        f.create_dataset('compressed', data=peak_data, chunks=(5, 32, 40),
+                         compression='gzip')
+        f.create_dataset('contiguous', data=peak_data)
+    return filename
+
+
+def test_slab_plan(data_file, peak_data):
+    frame_bytes = peak_data[0].nbytes
+    with h5.File(data_file, 'r') as f:
+        reader = NXReader(f, 'compressed', slab_bytes=12*frame_bytes)
+        assert reader.chunk_frames == 5 and reader.slab_frames == 10
+        slabs = [(i, j) for i, j, v in reader.slabs(3, 47)]
+        assert slabs == [(3, 10), (10, 20), (20, 30), (30, 40), (40, 47)]
+        slabs = [(i, j) for i, j, v in reader.slabs(0, 100, frames=7)]
+        assert slabs == [(0, 10), (10, 20), (20, 30), (30, 40), (40, 48)]
+        nslots, nbytes = reader.cache_settings()
+        assert nbytes == 4 * 5 * 32 * 40 * peak_data.itemsize
+        assert nslots == next_prime(400)
+        assert reader.data.id.get_access_plist().get_chunk_cache()[:2] == (
+            nslots, nbytes)
+        reader = NXReader(f, 'contiguous', slab_bytes=12*frame_bytes)
+        assert reader.chunk_frames == 1 and reader.slab_frames == 12
+        assert reader.data.id == f['contiguous'].id
+
+
+@pytest.mark.parametrize('path', ['compressed', 'contiguous'])
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_slabs(data_file, peak_data, path, prefetch):
+    with h5.File(data_file, 'r') as f:
+        reader = NXReader(f, path, slab_bytes=10*peak_data[0].nbytes,
+                          prefetch=prefetch)
+        for first, last in [(0, None), (7, 33), (45, 48)]:
+            slabs = [(i, j, v.copy()) for i, j, v in reader.slabs(first, last)]
+            assert np.array_equal(np.concatenate([v for i, j, v in slabs]),
+                                  peak_data[first:last])
+            assert all(v.shape[0] == j - i for i, j, v in slabs)
+
+
+@pytest.mark.parametrize('path', ['compressed', 'contiguous'])
+def test_buffer_reuse(data_file, peak_data, path):
+    with h5.File(data_file, 'r') as f:
+        reader = NXReader(f, path, slab_bytes=10*peak_data[0].nbytes)
+        slabs = list(reader.slabs())
+        assert len(slabs) == 5 and len(reader._buffers) == 1
+        buffer = reader._buffers[0]
+        assert all(v.base is buffer for i, j, v in slabs)
+        for i, j, v in reader.slabs():
+            assert np.array_equal(v, peak_data[i:j])
+        for i, j, v in reader.slabs(5, 25, frames=5):
+            assert np.shares_memory(v, buffer)
+        assert reader._buffers[0] is buffer
+        assert np.array_equal(reader.read(3, 9, out=buffer), peak_data[3:9])
+        assert np.array_equal(reader.read(3, 9), peak_data[3:9])
+        buffers = reader.buffers(3, 20)
+        assert len(buffers) == 3 and buffers[0].shape[0] == 20
@@ -0,0 +1,60 @@
+"""Compare the sparse 3D peak mask with the original dense mask."""
+import h5py as h5
+import numpy as np
+import pytest
+from nexusformat.nexus import NXfield, NXreflections
+
+from nxrefine.nxreduce import NXReduce
+from nxrefine.nxtransformer import peak_mask, read_peak_mask
+
+
+def reference_mask(shape, xp, yp, zp, radius, width):
+    """Return the dense mask created by the original 'calculate_mask'"""
+    mask = np.zeros(shape=shape, dtype=bool)
+    x, y = np.arange(shape[2]), np.arange(shape[1])
+    inside = np.array([(x[np.newaxis,:]-int(cx))**2 +
+                       (y[:,np.newaxis]-int(cy))**2 < radius**2
+                       for cx, cy in zip(xp, yp)], dtype=bool)
+    half_width = float(width) / 2.0
+    i, j = int(half_width-0.5), int(half_width+0.5)
+    for k, frame in enumerate([int(z) for z in zp]):
+        mask[frame-i:frame+j] = mask[frame-i:frame+j] | inside[k]
+    return mask
+
+
+def random_peaks(seed, shape, npeaks=30, width=5):
+    rng = np.random.default_rng(seed)
+    return (rng.uniform(-5, shape[2]+5, npeaks),
+            rng.uniform(-5, shape[1]+5, npeaks),
+            rng.uniform(width, shape[0]-width, npeaks))
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('radius, width', [(5, 3), (12.5, 4), (20, 7)])
+def test_sparse_mask(seed, radius, width):
+    shape = (40, 60, 70)
+    xp, yp, zp = random_peaks(seed, shape, width=width)
+    expected = reference_mask(shape, xp, yp, zp, radius, width)
+    mask = peak_mask(shape, xp, yp, zp, radius, width)
+    assert np.array_equal(mask.frames(0, shape[0]), expected)
+    assert np.array_equal(mask[7:23], expected[7:23])
+    assert np.array_equal(mask[11], expected[11])
+    assert np.array_equal(mask[5:30,10:20,:], expected[5:30,10:20,:])
+
+
+def test_calculate_mask(make_scan):
+    shape = (40, 60, 70)
+    directory = make_scan('scan', np.zeros(shape, dtype=np.int32),
+                          chunks=(8, 60, 70))
+    xp, yp, zp = random_peaks(0, shape)
+    reduce = NXReduce('f1', directory, radius=10, width=5)
+    reduce.entry['peaks'] = NXreflections(NXfield(xp, name='x'),
+                                          NXfield(yp, name='y'),
+                                          NXfield(zp, name='z'))
+    reduce.calculate_mask()
+    expected = reference_mask(shape, xp, yp, zp, 10, 5)
+    assert np.array_equal(read_peak_mask(reduce.mask_file)[:], expected)
+    with h5.File(reduce.mask_file, 'r') as f:
+        assert f['entry/mask'].compression == 'gzip'
+        assert not f['entry/mask'].shuffle
+        assert np.array_equal(f['entry/mask'][()], expected)
@@ -0,0 +1,46 @@
+"""Compare serial and block-parallel peak searches of synthetic frames."""
+import h5py as h5
+import numpy as np
+import pytest
+
+from nxrefine.nxpeaks import NXPeakSearch, search_block
+from nxrefine.nxreader import NXReader
+
+
+@pytest.fixture
+def data_file(tmp_path, peak_data):
+    filename = str(tmp_path / 'peaks.h5')
+    with h5.File(filename, 'w') as f:
+        f.create_dataset('entry/data/data', data=peak_data,
+                         chunks=(4, 64, 80), compression='gzip')
+    return filename
+
+
+def peak_array(peaks):
+    return np.array([(p.np, p.intensity, p.x, p.y, p.z, p.sigx, p.sigy,
+                      p.covxy) for p in peaks])
+
+
+@pytest.mark.parametrize('search3d', [False, True])
+@pytest.mark.parametrize('block_size', [4, 8, 20])
+def test_block_search(data_file, search3d, block_size):
+    threshold = 50.0
+    with h5.File(data_file, 'r') as f:
+        reader = NXReader(f, 'entry/data/data')
+        nframes = reader.shape[0]
+        serial = NXPeakSearch(reader.shape[-2:], threshold, search3d=search3d)
+        for i in serial.search_frames(reader, 0, nframes):
+            pass
+    parallel = NXPeakSearch((64, 80), threshold, search3d=search3d)
+    for first in range(0, nframes, block_size):
+        last = min(first+block_size, nframes)
+        parallel.add_table(search_block(data_file, 'entry/data/data',
+                                        threshold, first, last, 0, nframes,
+                                        search3d=search3d))
+    for search in serial, parallel:
+        search.pixel_tolerance, search.frame_tolerance = 5, 2
+    expected = serial.get_peaks(0, nframes)
+    peaks = parallel.get_peaks(0, nframes)
+    assert len(expected) > 10
+    assert len(peaks) == len(expected)
+    assert np.allclose(peak_array(peaks), peak_array(expected), rtol=1e-10)
@@ -0,0 +1,117 @@
+"""Tests of the cached geometry and refinement of NXRefine."""
+import numpy as np
+import pytest
+
+from nxrefine.nxrefine import NXRefine, rotmat
+
+
+@pytest.fixture
+def refine():
+    """Return an NXRefine instance with a monoclinic cell and random peaks"""
+    rng = np.random.default_rng(0)
+    refine = NXRefine()
+    refine.a, refine.b, refine.c = 4.1, 4.3, 5.2
+    refine.alpha, refine.beta, refine.gamma = 90.0, 95.0, 90.0
+    refine.symmetry = 'monoclinic'
+    refine.wavelength, refine.distance, refine.pixel_size = 0.2, 500.0, 0.172
+    refine.xc, refine.yc = 700.0, 800.0
+    refine.yaw, refine.pitch, refine.roll = 0.3, -0.5, 0.2
+    refine.chi, refine.omega, refine.gonpitch = -90.0, 1.0, 0.2
+    refine.phi, refine.phi_step = -5.0, 0.1
+    refine.Umat = rotmat(1, 10) * rotmat(2, 20) * rotmat(3, 30)
+    npeaks = 300
+    refine.xp = rng.uniform(0, 1475, npeaks)
+    refine.yp = rng.uniform(0, 1679, npeaks)
+    refine.zp = rng.uniform(0, 3600, npeaks)
+    refine.intensity = rng.uniform(1, 100, npeaks)
+    refine.polar_angle, refine.azimuthal_angle = refine.calculate_angles(
+        refine.xp, refine.yp)
+    refine.polar_max = 20.0
+    refine.hkl_tolerance = 0.2
+    return refine
+
+
+def test_cached_matrices(refine):
+    UBmat = refine.UBmat
+    assert refine.UBmat is UBmat
+    with pytest.raises(ValueError):
+        refine.Umat[0,0] = 1.0
+    with pytest.raises(ValueError):
+        refine.UBmat[0,0] = 1.0
+    Umat = np.matrix(refine.Umat)
+    Umat[0,0] += 0.01
+    refine.Umat = Umat
+    assert Umat.flags.writeable
+    assert np.allclose(refine.UBmat, Umat * refine.Bmat)
+    refine.a = 4.2
+    assert np.allclose(refine.UBmat, Umat * refine.Bmat)
+    assert not np.allclose(refine.UBmat, UBmat)
+
+
+def finite_difference(refine, name, eps=1e-6):
+    """Return the central difference of the hkl residuals"""
+    U0, value = refine.Umat, getattr(refine, name, None)
+    def diffs(delta):
+        if name.startswith('U'):
+            Umat = np.matrix(U0)
+            Umat[int(name[1]),int(name[2])] += delta
+            refine.Umat = Umat
+        else:
+            setattr(refine, name, value + delta)
+        return refine.diffs()
+    derivative = (diffs(eps) - diffs(-eps)) / (2 * eps)
+    if name.startswith('U'):
+        refine.Umat = U0
+    else:
+        setattr(refine, name, value)
+    return derivative
+
+
+def test_jacobian(refine):
+    refine.symmetry = 'triclinic'
+    refine.alpha, refine.gamma = 88.0, 93.0
+    refine.set_idx()
+    assert len(refine.idx) > 20
+    names = [name for name in NXRefine.jacobian_parameters
+             if name not in ('Rx', 'Ry', 'Rz')]
+    jacobian = refine.jacobian(names)
+    for i, name in enumerate(names):
+        expected = finite_difference(refine, name)
+        scale = max(np.abs(expected).max(), 1e-12)
+        assert np.abs(jacobian[:,i] - expected).max() / scale < 1e-4, name
+
+
+def test_rotation_jacobian(refine):
+    refine.set_idx()
+    p = refine.define_orientation_rotations()
+    jacobian = refine.rotation_jacobian(p)
+    for i, name in enumerate(['Rx', 'Ry', 'Rz']):
+        value, eps = p[name].value, 1e-6
+        p[name].value = value + eps
+        forward = refine.rotation_residuals(p)
+        p[name].value = value - eps
+        backward = refine.rotation_residuals(p)
+        p[name].value = value
+        expected = (forward - backward) / (2 * eps)
+        scale = max(np.abs(expected).max(), 1e-12)
+        assert np.abs(jacobian[:,i] - expected).max() / scale < 1e-4, name
+
+
+def test_geometry_maps(refine, tmp_path):
+    shape = (40, 50)
+    maps = refine.geometry_maps(shape)
+    assert maps.shape == (3,) + shape and maps.dtype == np.float32
+    y, x = np.ogrid[0:shape[0], 0:shape[1]]
+    polar, azimuthal = refine.calculate_angles(x, y)
+    assert np.allclose(maps[0], polar) and np.allclose(maps[1], azimuthal)
+    assert refine.geometry_maps(shape) is maps
+    refine.distance = 400.0
+    assert not np.allclose(refine.geometry_maps(shape)[0], maps[0])
+    assert list(tmp_path.iterdir()) == []
+    directory = str(tmp_path / 'geometry')
+    refine.invalidate()
+    maps = refine.geometry_maps(shape, directory)
+    assert len(list((tmp_path / 'geometry').iterdir())) == 1
+    refine.invalidate()
+    saved = refine.geometry_maps(shape, directory)
+    assert isinstance(saved, np.memmap) and np.array_equal(saved, maps)
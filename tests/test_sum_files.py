@@ -0,0 +1,49 @@
+"""Test the summation of the raw data of repeated scans."""
+import os
+
+import h5py as h5
+import numpy as np
+import pytest
+
+from nxrefine.nxreader import NXReader
+from nxrefine.nxreduce import NXReduce
+
+
+@pytest.fixture
+def scans(make_scan, monkeypatch):
+    monkeypatch.setattr(NXReader, 'slab_bytes', 5 * 30 * 40 * 4)
+    rng = np.random.default_rng(0)
+    data = [rng.poisson(5, (23, 30, 40)).astype(np.int32) for _ in range(3)]
+    for i, d in enumerate(data):
+        make_scan('scan%d' % i, d, chunks=(5, 30, 40), compression='gzip')
+    os.remove(os.path.join(make_scan('missing', data[0]), 'f1.h5'))
+    directory = make_scan('sum', np.zeros_like(data[0]))
+    return directory, data
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_sum_files(scans, workers):
+    directory, data = scans
+    reduce = NXReduce('f1', directory, workers=workers)
+    reduce.sum_files(['scan0', 'scan1', 'missing', 'scan2'])
+    assert not os.path.exists(reduce.data_file + '.tmp')
+    with h5.File(reduce.data_file, 'r') as f:
+        field = f['entry/data/data']
+        assert np.array_equal(field[()], sum(data))
+        assert field.chunks == (5, 30, 40) and field.compression == 'gzip'
+        link = f['entry/data'].get('monitor', getlink=True)
+        assert isinstance(link, h5.SoftLink) and link.path == '/entry/monitor'
+        assert np.array_equal(f['entry/data/monitor'][()], np.arange(23))
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_stopped_sum(scans, workers):
+    directory, data = scans
+    reduce = NXReduce('f1', directory, workers=workers)
+    def stop(i):
+        reduce.stopped = True
+    reduce.update_progress = stop
+    reduce.sum_files(['scan0', 'scan1', 'scan2'])
+    assert not os.path.exists(reduce.data_file + '.tmp')
+    with h5.File(reduce.data_file, 'r') as f:
+        assert not f['entry/data/data'][()].any()
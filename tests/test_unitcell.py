@@ -0,0 +1,96 @@
+"""Compare the unit cell reflections and powder rings with a direct search."""
+import math
+
+import numpy as np
+import pytest
+
+from nxrefine import unitcell as uc
+
+
+cells = [([30, 35, 40, 90, 90, 90], 'C', 0.6),
+         ([5.43, 5.43, 5.43, 90, 90, 90], 'F', 3.0),
+         ([7.1, 8.3, 9.2, 81, 97, 104], 'P', 1.5),
+         ([4.2, 4.2, 11.3, 90, 90, 120], 'R', 2.5),
+         ([3.9, 3.9, 3.9, 90, 90, 90], 'I', 4.0)]
+
+
+def reference_peaks(cell, dsmax):
+    """Return [ds, (h,k,l)] of every allowed reflection with ds < dsmax"""
+    hmax, kmax, lmax = [int(math.floor(dsmax*math.sqrt(cell.g[i,i])))
+                        for i in range(3)]
+    peaks = []
+    for h in range(-hmax, hmax+1):
+        for k in range(-kmax, kmax+1):
+            for l in range(-lmax, lmax+1):
+                if (h, k, l) != (0, 0, 0) and not cell.absent(h, k, l):
+                    ds = cell.ds([h, k, l])
+                    if ds < dsmax:
+                        peaks.append([ds, (h, k, l)])
+    return sorted(peaks, key=lambda p: (round(p[0], 10), p[1]))
+
+
+def reference_rings(peaks, tol):
+    """Group the peaks into rings as in the original 'makerings'"""
+    ringds, ringhkls = [peaks[0][0]], {peaks[0][0]: [peaks[0][1]]}
+    for ds, hkl in peaks[1:]:
+        if abs(ds - ringds[-1]) < tol:
+            ringhkls[ringds[-1]].append(hkl)
+        else:
+            ringds.append(ds)
+            ringhkls[ds] = [hkl]
+    return ringds, ringhkls
+
+
+def assert_rings(cell, limit, tol=0.001):
+    ringds, ringhkls = reference_rings(reference_peaks(cell, limit+tol), tol)
+    assert np.allclose(cell.ringds, ringds, rtol=1e-12)
+    assert ([sorted(cell.ringhkls[ds]) for ds in cell.ringds] ==
+            [sorted(ringhkls[ds]) for ds in ringds])
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    uc.hkl_cache.clear()
+
+
+@pytest.mark.parametrize('lattice, symmetry, dsmax', cells)
+def test_rings(lattice, symmetry, dsmax):
+    cell = uc.unitcell(lattice, symmetry)
+    peaks = sorted(cell.gethkls(dsmax+0.001), key=lambda p: p[1])
+    expected = sorted(reference_peaks(cell, dsmax+0.001), key=lambda p: p[1])
+    assert [p[1] for p in peaks] == [p[1] for p in expected]
+    assert np.allclose([p[0] for p in peaks], [p[0] for p in expected],
+                       rtol=1e-12)
+    assert np.all(np.diff([p[0] for p in cell.peaks]) > -1e-12)
+    cell.makerings(dsmax)
+    assert_rings(cell, dsmax)
+    for limit in (dsmax * 1.2, dsmax * 0.7):
+        cell.makerings(limit)
+        assert_rings(cell, limit)
+
+
+@pytest.mark.parametrize('lattice, symmetry, dsmax', cells)
+def test_angles(lattice, symmetry, dsmax):
+    cell = uc.unitcell(lattice, symmetry)
+    cell.makerings(dsmax)
+    for ring1, ring2 in [(0, 1), (1, 3), (2, 2)]:
+        hkls, cosines = cell.getanglehkls(ring1, ring2)
+        expected = [(ha, hb) for ha in cell.ringhkls[cell.ringds[ring1]]
+                    for hb in cell.ringhkls[cell.ringds[ring2]] if ha != hb]
+        assert hkls == expected
+        assert np.allclose(cosines, [cell.anglehkls(ha, hb)[1]
+                                     for ha, hb in expected])
+        assert cell.getanglehkls(ring1, ring2)[0] is hkls
+
+
+def test_memoized_rings():
+    lattice, symmetry, dsmax = cells[0]
+    cell = uc.unitcell(lattice, symmetry)
+    cell.makerings(dsmax)
+    ringhkls = cell.ringhkls
+    cell.makerings(dsmax)
+    assert cell.ringhkls is ringhkls
+    other = uc.unitcell(lattice, symmetry)
+    other.makerings(dsmax)
+    assert other.ringds == cell.ringds
+    assert other.hklarray is cell.hklarray